@@ -5,12 +5,22 @@ retrieves records from the database and calls smaller ETL workflows to refresh r
 
 GET requests hit the table specified in the db.Model object defined below, 
 returning either all records in the table (at the base route '/') or just 
-one record (at an objectid-specific route '/<objectid>'). 
+one record (at an objectid-specific route '/<objectid>'). The base route streams the whole 
+table, or returns one page of it when given 'limit' (and 'after') query args, e.g. '/?limit=500&after=1500'. 
+Reads take 'fields' (columns to return) and 'geometry' args, and '/records' (or '/?ids=...') looks up 
+many records by id in one query. 
+Spatial queries (bbox, point-radius, intersects and nearest) are answered as GeoJSON at '/query', 
+and web maps can load the table as Mapbox Vector Tiles from '/tiles/<z>/<x>/<y>.mvt'. 
+The whole table can be exported as GeoParquet, Arrow IPC or FlatGeobuf at '/export/<parquet|arrow|fgb>'. 
+These geometry routes take a 'resolution' arg ('full', 'medium' or 'low') to serve simplified geometry. 
 
 POST requests are used to refresh records (which are then returned), and can access 
-between 1 and 1000 records, or the entire table's worth (at the base route '/'). 
-They accept a request JSON in the following structure, where <id values> is a list of ids (of length 
-1-1000), or the string "all" (to refresh everything; only available at the base route '/'). 
+any number of records (fetched from ArcGIS in batches), or the entire table's worth (at the base route '/'). 
+They accept a request JSON in the following structure, where <id values> is a list of ids, 
+or the string "all" (to refresh everything; only available at the base route '/'). 
+Refreshing "all" runs as a background job: the response (202) carries a job id, whose progress 
+is reported at '/jobs/<job id>'. Posting "all" to '/?mode=delta' only syncs features edited since the last refresh. 
+Prometheus metrics (etl stage timings, row/byte counts and request latencies) are served at '/metrics'. 
     ```
     {
         "objectid" : [<id values>]
@@ -18,34 +28,84 @@ They accept a request JSON in the following structure, where <id values> is a li
     ```
 """
 
-from flask import Flask, request
+import json
+import math
+import time
+import hashlib
+import logging
+import cProfile
+from threading import Lock
+from flask import Flask, Response, abort, g, request, send_file, stream_with_context
 from flask_sqlalchemy import SQLAlchemy as sa
 from flask_migrate import Migrate as mi
+import os
+import tempfile
 import etl_functions as ef
+import cache_functions as cf
+import export_functions as xf
+import job_functions as jf
+import metrics_functions as mf
 import etl_params as ep
 
 # initialize database dictionary
 dbase = ep.postgres1 # not to be confused with variable 'db', a flask-sa instance
 
-user = dbase['user']
-pw = dbase['password']
-host = dbase['host']
-database = dbase['database']
-
 # initialize data source dictionary
 dsource = ep.zoning
 
+# log the etl functions' progress along with the app's own messages
+logging.basicConfig(level=dbase.get('log_level', 'INFO'), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
 # initialize app variables
 app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql://{user}:{pw}@{host}/{database}'
+app.config['SQLALCHEMY_DATABASE_URI'] = ef.mk_postgis_engine(dbase, mk_engine=False)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = ef.engine_options(dbase)  # pool size, pre-ping and recycle settings
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # initialize flask-sqlalchemy and flask-migrate instances to manage db querying and transactions
 db = sa(app)
 migrate = mi(app, db)
 
-# define a data model to teach flask the structure of postgres tables
-# TODO: Update this with whatever table structure ur using (or create a function to automate)
+# share flask-sqlalchemy's connection pool with the etl helpers, so every route borrows from one pool
+with app.app_context():
+    ef.register_engine(dbase, db.engine)
+
+# cache GET responses until the table changes (see cached_get), up to 'cache_bytes' in total;
+# a 'cache_url' shares entries through redis
+response_cache = cf.ResponseCache(
+    max_entries=dbase.get('cache_entries', 256),
+    ttl=dbase.get('cache_ttl', 300),
+    max_bytes=dbase.get('cache_bytes', 256 * 2**20),
+    redis_url=dbase.get('cache_url')
+)
+
+# cache vector tiles until a refresh touches them (see refreshed), up to 'tile_cache_bytes' in total
+tile_cache = cf.TileCache(
+    max_entries=dbase.get('tile_cache_entries', 100000),
+    ttl=dbase.get('tile_cache_ttl', 86400),
+    max_bytes=dbase.get('tile_cache_bytes', 256 * 2**20)
+)
+tile_state = {"version": None}  # table version the cached tiles were made from
+tile_lock = Lock()  # orders caching a rendered tile with invalidating tiles (see get_tile)
+
+# run full-table refreshes in the background, on 'job_workers' threads (see refresh_all)
+jobs = jf.JobQueue(workers=dbase.get('job_workers', 1))
+
+# coalesce the record refreshes requested within 'refresh_window' seconds into one fetch and write (see refresh_records)
+refresh_batcher = jf.Batcher(
+    lambda oids: refresh_records(oids),
+    window=dbase.get('refresh_window', 0.05),
+    max_items=dbase.get('refresh_batch', dsource['max_records'])
+)
+
+# only one request can be profiled at a time (see start_request)
+profile_lock = Lock()
+
+# the table's columns and stored geometry levels, as reflected at a table version (see table_columns)
+column_state = {"version": None, "fields": None, "levels": None}
+
+# define a data model to teach flask(-migrate) the structure of postgres tables
+# NOTE: routes don't depend on these fields; they read the table's columns from the database (see table_columns)
 class TaxlotModel(db.Model):
     __tablename__ = dbase['table']  # NOTE: makes table name dynamic, but fields still need to be manually configured 
 
@@ -72,6 +132,355 @@ class TaxlotModel(db.Model):
         return f'<Taxlot {self.OBJECTID}>'
 
 
+def stream_records(message:str, records, chunk_size:int=500):
+    """
+    joins an iterable of json records (text, e.g. from ef.json_records) into the same json
+    document the routes return ({"message", "records", "count"}), yielding it in chunks so
+    it can be streamed.
+    """
+    yield f'{{"message": {json.dumps(message)}, "records": ['
+
+    count = 0
+    chunk = []
+
+    for record in records:
+        chunk.append(record)
+        count += 1
+
+        if len(chunk) == chunk_size:
+            yield ('' if count == chunk_size else ', ') + ', '.join(chunk)
+            chunk = []
+
+    if chunk:
+        yield ('' if count == len(chunk) else ', ') + ', '.join(chunk)
+
+    yield f'], "count": {count}}}'
+
+
+def records_response(message:str, records:list, **extra) -> str:
+    """
+    returns the json document the routes answer with ({"message", "count", <extra keys>,
+    "records"}), given records as json text (e.g. from ef.json_records)
+    """
+    extras = ''.join(f', {json.dumps(k)}: {json.dumps(v, default=str)}' for k, v in extra.items())
+
+    return f'{{"message": {json.dumps(message)}, "count": {len(records)}{extras}, "records": [{", ".join(records)}]}}'
+
+def table_columns() -> list:
+    """
+    returns the table's (non-geometry) columns, reflected from the database whenever the
+    table's version changes (see ef.table_fields)
+    """
+    version = current_version()
+
+    if column_state["version"] != version:
+        column_state.update(
+            fields=ef.table_fields(dbase, dbase['table']),
+            levels=[c[len('geometry_'):] for c in ef.table_fields(dbase, dbase['table'], geometry=True) if c.startswith('geometry_')],
+            version=version
+        )
+
+    return column_state["fields"]
+
+def stored_levels() -> list:
+    """
+    returns the simplified geometry levels the table actually stores (see ef.ensure_resolutions),
+    which can lag dbase['resolutions'] until the table's next load or sync
+    """
+    table_columns()
+
+    return column_state["levels"]
+
+def record_ids(values) -> list:
+    """
+    returns a list of OBJECTID values as ints, raising a ValueError if any isn't a number
+    """
+    return [int(v) for v in values]
+
+def current_version() -> int:
+    """
+    returns the table's version number (see ef.table_version), re-reading it from the
+    database at most once every dbase['version_ttl'] seconds (default 1)
+    """
+    version = response_cache.get('version')
+
+    if version is None:
+        version = str(ef.table_version(dbase, dbase['table'])).encode()
+        response_cache.set('version', version, ttl=dbase.get('version_ttl', 1), shared=False)
+
+    return int(version)
+
+def cached_get(render, mimetype:str='application/json'):
+    """
+    serves a GET request from the response cache when possible, keyed by the request's
+    path/args and the table version. on a miss, render() builds the body, either as a
+    string or as an iterable of chunks (which is streamed, and cached once complete if it's
+    no larger than dbase['cache_max_body'] bytes).
+
+    responses carry an ETag, so clients sending a matching If-None-Match get an empty 304.
+    """
+    key = f'{request.full_path}@{current_version()}'
+    etag = hashlib.md5(key.encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    body = response_cache.get(key)
+
+    if body is None:
+        body = render()
+
+        if isinstance(body, str):
+            response_cache.set(key, body.encode())
+        else:
+            body = stream_with_context(response_cache.tee(key, body, max_size=dbase.get('cache_max_body', 50_000_000)))
+
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+
+    return response
+
+def refreshed(gdf=None, old_extent:tuple=None) -> None:
+    """
+    drops cached data after this process refreshes the table: every cached response, and
+    either the tiles overlapping the refreshed records (given the refreshed gdf and the
+    records' extent before the refresh) or, after a full refresh, every tile.
+    """
+    response_cache.clear()
+    version = ef.table_version(dbase, dbase['table'])
+
+    with tile_lock:
+        if gdf is None:
+            tile_cache.clear()
+        elif len(gdf):
+            bounds = tuple(gdf.total_bounds)
+
+            # records refreshed without geometry have no bounds to go by
+            if any(math.isnan(b) for b in bounds):
+                tile_cache.clear()
+            else:
+                tile_cache.invalidate_boxes([old_extent, bounds])
+
+        tile_state["version"] = version
+
+def refresh_records(oids:list) -> dict:
+    """
+    refreshes a batch of records (the OBJECTIDs asked for by every request in the batch, see
+    refresh_batcher) with one fetch from arcgis and one upsert, drops the cached data they
+    made stale, and returns the refreshed records as json text (see ef.json_records), by OBJECTID
+    """
+    app.logger.info('updating records where OBJECTID = %s', oids)
+
+    gdf = ef.oids_to_gdf(dsource, oids)
+    old_extent = ef.extent_of(dbase, dbase['table'], oids)
+
+    if len(gdf):
+        ef.update_with_gdf(dbase, dbase["table"], gdf)
+
+    # cached responses and the tiles these records were (or now are) in are stale
+    refreshed(gdf, old_extent)
+
+    # pull the refreshed records from the db, serialized to json by postgres
+    records = ef.json_records(dbase, dbase['table'], table_columns(), oid_list=oids)
+
+    return {json.loads(record)['OBJECTID']: record for record in records}
+
+def refresh(oids:list) -> list:
+    """
+    refreshes records through refresh_batcher, so concurrent requests share one round trip
+    to arcgis and the database, and returns this request's records in OBJECTID order
+    """
+    records = refresh_batcher.submit(oids)
+
+    return [records[oid] for oid in sorted(set(oids)) if oid in records]
+
+def refresh_all(mode:str):
+    """
+    returns a job (for the JobQueue) that refreshes the whole table: either by fetching every
+    record and writing only those that changed, deleting the ones that are gone (mode 'full',
+    see ef.merge_pages), or by syncing the records edited since the last refresh (mode
+    'delta', see ef.delta_sync). the table keeps serving reads throughout.
+    """
+    def job(progress):
+        if mode == 'delta':
+            result = ef.delta_sync(dsource, dbase, dbase['table'], reconcile_deletes=True, progress=progress)
+        else:
+            result = ef.merge_pages(dbase, dbase['table'], ef.ags_pages(dsource), progress=progress)
+
+        refreshed()
+        app.logger.info('%s refresh of %s complete', mode, dbase["table"])
+
+        return result
+
+    return job
+
+def read_args(args) -> dict:
+    """
+    reads record read parameters (see ef.json_records) from request args, where lists are
+    comma-separated ('ids=1,5,10&fields=ZONE_CLASS,ZONE_SMRY'), or from a json body using
+    lists: 'ids' (OBJECTIDs to return), 'fields' (columns to return; OBJECTID is always
+    included, and every column is returned by default), 'geometry' (true to include each
+    record's geometry as geojson) and 'resolution' (the level of that geometry).
+    raises a ValueError if they're malformed.
+    """
+    def listed(name):
+        value = args.get(name)
+
+        if isinstance(value, str):
+            value = [v.strip() for v in value.split(',') if v.strip()]
+
+        return value
+
+    columns = table_columns()
+    ids = listed('ids')
+    fields = listed('fields')
+
+    if fields is not None:
+        unknown = [f for f in fields if f not in columns]
+
+        if unknown:
+            raise ValueError(f"unknown fields: {', '.join(unknown)}")
+
+        fields = ['OBJECTID'] + [f for f in dict.fromkeys(fields) if f != 'OBJECTID']
+
+    geometry = args.get('geometry', False)
+
+    if isinstance(geometry, str):
+        geometry = geometry.lower() in ('1', 'true', 'yes')
+
+    return {
+        "fields": fields or columns,
+        "oid_list": record_ids(ids) if ids is not None else None,
+        "geometry": bool(geometry),
+        "resolution": resolution_arg(args),
+    }
+
+def page_args(args) -> dict:
+    """
+    reads the keyset pagination args ('limit', a positive number of records, and 'after', an
+    OBJECTID) from request args, raising a ValueError if they're malformed
+    """
+    limit = args.get('limit')
+    after = args.get('after')
+
+    limit = int(limit) if limit is not None else None
+    after = int(after) if after is not None else None
+
+    if limit is not None and limit < 1:
+        raise ValueError("'limit' must be a positive number")
+
+    return {"limit": limit, "after": after}
+
+def spatial_args(args) -> dict:
+    """
+    reads spatial query parameters (see ef.spatial_query) from request args, where
+    coordinates are comma-separated ('bbox=-123.1,44.0,-123.0,44.1') and 'intersects' is a
+    geojson geometry string, or from a json body using lists and a geojson object.
+    raises a ValueError if they're malformed.
+    """
+    def coords(name, count):
+        value = args.get(name)
+
+        if value is None:
+            return None
+
+        if isinstance(value, str):
+            value = value.split(',')
+
+        value = [float(c) for c in value]
+
+        if len(value) != count:
+            raise ValueError(f"'{name}' needs {count} coordinates")
+
+        return value
+
+    intersects = args.get('intersects')
+
+    if intersects is not None and not isinstance(intersects, str):
+        intersects = json.dumps(intersects)
+
+    def count(name, default):
+        value = int(args.get(name, default))
+
+        if value < 1:
+            raise ValueError(f"'{name}' must be a positive number")
+
+        return value
+
+    radius = args.get('radius')
+
+    return {
+        "bbox": coords('bbox', 4),
+        "point": coords('point', 2),
+        "radius": float(radius) if radius is not None else None,
+        "intersects": intersects,
+        "nearest": coords('nearest', 2),
+        "k": count('k', 10),
+        "limit": count('limit', 1000),
+        "resolution": resolution_arg(args),
+    }
+
+def resolution_arg(args, default:str=None) -> str:
+    """
+    reads the 'resolution' arg ('full', or a simplified level such as 'medium' or 'low',
+    see ef.geometry_column), raising a ValueError if the level isn't stored
+    """
+    resolution = args.get('resolution', default)
+    ef.geometry_column(dbase, resolution)
+
+    if resolution not in (None, 'full') and resolution not in stored_levels():
+        raise ValueError(f"resolution '{resolution}' isn't stored in the table yet")
+
+    return resolution
+
+def tile_resolution(z:int) -> str:
+    """
+    returns the geometry level drawn at zoom z by default: the first level in
+    dbase['tile_resolutions'] (a list of [max zoom, level] pairs, lowest zoom first) whose max
+    zoom is at least z, if the table stores that level, or else the full geometry
+    """
+    levels = stored_levels()
+
+    for max_zoom, level in dbase.get('tile_resolutions', [[11, 'low'], [14, 'medium']]):
+        if z <= max_zoom and level in levels:
+            return level
+
+    return 'full'
+
+
+@app.before_request
+def start_request():
+    # requests sent with a 'profile' arg are run under cProfile when dbase['profile_dir'] is set
+    # (see finish_request). one at a time: a request that arrives mid-profile just runs normally.
+    g.started = time.perf_counter()
+
+    if dbase.get('profile_dir') and request.args.get('profile') and profile_lock.acquire(blocking=False):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def finish_request(response):
+    # records the request's latency (up to the start of a streamed body) by route, method and status,
+    # and saves the profile of a profiled request to dbase['profile_dir'], named in the X-Profile header
+    profiler = g.pop('profiler', None)
+
+    if profiler is not None:
+        profiler.disable()
+        profile_lock.release()
+
+        os.makedirs(dbase['profile_dir'], exist_ok=True)
+        filename = f'{int(time.time() * 1000)}-{request.endpoint}.prof'
+        profiler.dump_stats(os.path.join(dbase['profile_dir'], filename))
+
+        response.headers['X-Profile'] = filename
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    mf.observe('api_request_seconds', time.perf_counter() - g.started, route=route, method=request.method, status=response.status_code)
+
+    return response
+
 @app.route('/', methods=['POST', 'GET'])
 def handle_taxlots():  #for record creation and getting ALL records
     
@@ -84,63 +493,219 @@ def handle_taxlots():  #for record creation and getting ALL records
             # if fieldname == objectid, query with the objectid-based function
             if "objectid" in data and len(data) == 1:
 
-                # get a geodataframe with the records corresponding with requested objectids (doesn't support lists longer than 1000)
-                gdf = ef.oids_to_gdf(dsource, data["objectid"])
-
-                # TODO: Make functions to run based on what table name the user requests records from (how to know??)
-                    # whatever happens here will return a processed gdf with records matching those existing in the table
-                
-                # load final geodataframe into postgres (TODO: replace 'gdf' with the processed gdf once funcs are in place)
-                if data["objectid"] == ["all"] or 'all':
-                    print('replacing all records')
-
-                    # if the user is looking to refresh all records, replace the table with the new gdf...
-                    engine = ef.mk_postgis_engine(dbase)
-                    gdf.to_postgis(dbase['table'], engine, dbase['schema'], if_exists=dbase['if_exists']) # this is a geopandas method
-                    
-                    print('all records successfully refreshed in postgres')
+                # if the user is looking to refresh all records, submit a background job and report its id.
+                # '/?mode=delta' only syncs features edited since the last refresh (and drops deleted ones).
+                # an identical refresh that's already queued or running is reused rather than started again.
+                if data["objectid"] in (["all"], "all"):
+                    mode = 'delta' if request.args.get('mode') == 'delta' else 'full'
+                    job, created = jobs.submit((dbase['table'], mode), refresh_all(mode))
 
-                else:
-                    # ...otherwise, just update the records that need it
-                    print(f'updating records where OBJECTID = {data["objectid"]}')
+                    return {
+                        "message": f"accepted: {mode} refresh of table {dbase['table']} {'submitted' if created else 'already in progress'}",
+                        "job": job["id"],
+                        "status": f"/jobs/{job['id']}"
+                    }, 202
 
-                    ef.update_with_gdf(dbase, dbase["table"], gdf)
+                # otherwise, fetch the requested records and update just those (see refresh_records)
+                try:
+                    oids = record_ids(data["objectid"])
+                except (TypeError, ValueError):
+                    return {"message": "error: 'objectid' must be a list of numbers, or [\"all\"]"}, 400
 
-                # pull records from db as list of dictionaries
-                records = ef.retrieve_from_postgis(dbase, dbase['table'], data['objectid'])
+                # fetched and written along with any other refreshes requested at the same time
+                records = refresh(oids)
 
                 # return records and/or message
-                return {
-                    "message": f"success: refreshed table {dbase['table']} for OBJECTID values {data['objectid']}",
-                    "count": len(records),
-                    "records": records
-                }
+                return Response(records_response(f"success: refreshed table {dbase['table']} for OBJECTID values {data['objectid']}", records), mimetype='application/json')
 
             else:
                 return {"message": "error: haven't developed handling for fields other than OBJECTID"}
             
+    # GET requests accept optional 'limit' and 'after' args for keyset pagination on OBJECTID,
+    # e.g. '/?limit=500&after=1500'. the response's "next" value is the 'after' for the next page.
+    # without a limit, every record (after 'after', if given) is streamed back from a server-side cursor.
+    # 'ids' returns just those records, 'fields' just those columns, and 'geometry' adds geometry
+    # (see read_args), e.g. '/?ids=1,5,10&fields=ZONE_CLASS&geometry=true&resolution=low'.
+    # records are serialized to json by postgres, and responses are cached until the table changes.
     elif request.method == 'GET':
-        records = TaxlotModel.query.all()
-        results = [
-            {
-                'OBJECTID': record.OBJECTID,
-                'ZONE_CMPLT': record.ZONE_CMPLT,
-                'ZONE_CLASS': record.ZONE_CLASS,
-                'ZONE_SMRY': record.ZONE_SMRY,
-                'Shape__Area': record.Shape__Area,
-                'Shape__Length': record.Shape__Length,
-                'timestamp': record.timestamp,
+        try:
+            page = page_args(request.args)
+            read = read_args(request.args)
+        except (TypeError, ValueError) as e:
+            return {"message": f"error: {e}"}, 400
+
+        limit, after = page["limit"], page["after"]
+
+        def render():
+            if limit:
+                records = list(ef.json_records(dbase, dbase['table'], after=after, limit=limit, **read))
+                next_after = json.loads(records[-1])['OBJECTID'] if len(records) == limit else None
+
+                return records_response("success: page of records retrieved", records, next=next_after)
+
+            records = ef.json_records(dbase, dbase['table'], after=after, **read)
+
+            return stream_records(f"success: {'requested' if read['oid_list'] is not None else 'all'} records retrieved", records)
+
+        return cached_get(render)
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id): # for checking on background refreshes
+    job = jobs.status(job_id)
+
+    if job is None:
+        return {"message": f"error: no job with id {job_id}"}, 404
+
+    return {"message": f"success: job {job_id} is {job['status']}", "job": job}
+
+@app.route('/metrics')
+def metrics(): # for prometheus, reports etl stage timings, row/byte counts and request latencies
+    return Response(mf.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/records', methods=['POST', 'GET'])
+def lookup_taxlots(): # for reading many records by id in one request
+
+    # accepts 'ids' along with optional 'fields', 'geometry' and 'resolution' (see read_args),
+    # as GET args or as a POST json body (for id lists too long for a url), e.g.
+    # {"ids": [1, 5, 10], "fields": ["ZONE_CLASS"], "geometry": true}. nothing is refreshed.
+    source = request.get_json() if request.method == 'POST' and request.is_json else request.args
+
+    try:
+        read = read_args(source)
+    except (TypeError, ValueError) as e:
+        return {"message": f"error: {e}"}, 400
+
+    if read["oid_list"] is None:
+        return {"message": "error: provide 'ids'"}, 400
+
+    def render():
+        records = list(ef.json_records(dbase, dbase['table'], **read))
+
+        return records_response("success: requested records retrieved", records)
+
+    # POST bodies aren't part of the cache key, so only GET lookups are cached
+    if request.method == 'POST':
+        return Response(render(), mimetype='application/json')
+
+    return cached_get(render)
+
+@app.route('/query', methods=['POST', 'GET'])
+def query_taxlots(): # for spatial queries, answered as geojson
+    
+    # accepts any combination of 'bbox', 'point' + 'radius' (meters), 'intersects' and 'nearest' (+ 'k'),
+    # as GET args or as a POST json body, e.g. '/query?point=-123.09,44.05&radius=250'.
+    # coordinates are wgs84 longitude/latitude. at most 'limit' (default 1000) features are returned.
+    # 'resolution' ('full', 'medium' or 'low') picks how detailed the returned geometry is.
+    source = request.get_json() if request.method == 'POST' and request.is_json else request.args
+
+    try:
+        spatial = spatial_args(source)
+    except (TypeError, ValueError) as e:
+        return {"message": f"error: {e}"}, 400
+
+    if not (spatial["bbox"] or spatial["intersects"] or spatial["nearest"] or (spatial["point"] and spatial["radius"] is not None)):
+        return {"message": "error: provide 'bbox', 'point' and 'radius', 'intersects' or 'nearest'"}, 400
+
+    fields = table_columns()
 
-            } for record in records]
+    def render():
+        return ef.spatial_query(dbase, dbase['table'], fields, **spatial)
 
-        return {"message": "success: all records retrieved", "count": len(results), "records": results}
+    # POST bodies aren't part of the cache key, so only GET queries are cached
+    if request.method == 'POST':
+        return Response(render(), mimetype='application/geo+json')
+
+    return cached_get(render, mimetype='application/geo+json')
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.mvt')
+def get_tile(z, x, y): # for web maps, serves the table as mapbox vector tiles
+    if x >= 2 ** z or y >= 2 ** z:
+        return {"message": f"error: tile {z}/{x}/{y} doesn't exist"}, 404
+
+    # geometry is simplified for low zooms (see tile_resolution), unless a 'resolution' arg says otherwise
+    try:
+        resolution = resolution_arg(request.args, tile_resolution(z))
+    except ValueError as e:
+        return {"message": f"error: {e}"}, 400
+
+    # if the table changed outside this process (e.g. an etl.py run), no cached tile can be trusted
+    version = current_version()
+
+    with tile_lock:
+        if tile_state["version"] != version:
+            tile_cache.clear()
+            tile_state["version"] = version
+
+    key = f'{z}/{x}/{y}@{resolution}'
+    tile = tile_cache.get(key)
+
+    if tile is None:
+        # tiles carry the OBJECTID and ZONE_* attributes
+        fields = [f for f in table_columns() if f == 'OBJECTID' or f.startswith('ZONE_')]
+
+        tile = ef.mvt_tile(dbase, dbase['table'], z, x, y, fields, layer=dbase.get('tile_layer'), resolution=resolution)
+
+        # a refresh that landed while the tile was rendering may already have invalidated it,
+        # so it's only cached if the tiles are still at the version it was rendered from
+        with tile_lock:
+            if tile_state["version"] == version:
+                tile_cache.set(key, tile)
+
+    response = Response(tile, mimetype='application/vnd.mapbox-vector-tile')
+    response.set_etag(hashlib.md5(tile).hexdigest())
+
+    return response.make_conditional(request)
+
+@app.route('/export/<fmt>')
+def export_taxlots(fmt): # for analytics consumers, serves the whole table (with geometry) as a columnar file
+
+    # 'parquet' (GeoParquet) and 'arrow' (Arrow IPC stream) are streamed as they're written, page by page.
+    # 'fgb' (FlatGeobuf) is written to a temporary file first, which is removed once it's sent.
+    # 'resolution' ('full', 'medium' or 'low') picks how detailed the exported geometry is.
+    try:
+        resolution = resolution_arg(request.args)
+    except ValueError as e:
+        return {"message": f"error: {e}"}, 400
+
+    pages = ef.read_pages(dbase, dbase['table'], resolution=resolution)
+    filename = f"{dbase['table']}.{fmt}"
+    disposition = {"Content-Disposition": f"attachment; filename={filename}"}
+
+    if fmt == 'parquet':
+        return Response(stream_with_context(xf.parquet_stream(pages)), mimetype='application/vnd.apache.parquet', headers=disposition)
+
+    elif fmt == 'arrow':
+        return Response(stream_with_context(xf.arrow_stream(pages)), mimetype='application/vnd.apache.arrow.stream', headers=disposition)
+
+    elif fmt == 'fgb':
+        fd, path = tempfile.mkstemp(suffix='.fgb')
+        os.close(fd)
+        os.remove(path)  # the FlatGeobuf driver creates the file itself
+
+        xf.write_flatgeobuf(pages, path)
+
+        response = send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=filename)
+        response.call_on_close(lambda: os.remove(path))
+
+        return response
+
+    return {"message": f"error: unsupported export format '{fmt}' (use 'parquet', 'arrow' or 'fgb')"}, 404
 
 @app.route('/<record_id>', methods=['POST', 'GET'])
 def handle_taxlot(record_id): # for engaging one record at a time
-    record = TaxlotModel.query.get_or_404(record_id) # if the record_id isn't in the db, it cannot have a webpage
+
+    # if the record_id isn't a number, it cannot have a webpage
+    try:
+        oid = int(record_id)
+    except ValueError:
+        abort(404)
 
     # NOTE: the POST request {"objectid" : "all"} doesn't work at this route
     if request.method == 'POST':
+        # if the record_id isn't in the db, it cannot have a webpage
+        if not list(ef.json_records(dbase, dbase['table'], ['OBJECTID'], oid_list=[oid])):
+            abort(404)
+
         if request.is_json:
             data = request.get_json()
 
@@ -151,39 +716,38 @@ def handle_taxlot(record_id): # for engaging one record at a time
                 if data["objectid"] in (["all"], "all"):
                     return {"message": "error: refreshing records with 'all' is only supported at the base route '/'"}
                 
-                # get a geodataframe with the records corresponding with requested objectids
-                gdf = ef.oids_to_gdf(dsource, data["objectid"])
-
-                # TODO: Make functions to run based on what table name the user requests records from (how to know??)
-                    # whatever happens here will return a processed gdf with records matching those existing in the table
-                
-                # load final geodataframe into postgres (TODO: replace 'gdf' with the processed gdf once funcs are in place)
-                ef.update_with_gdf(dbase, dbase["table"], gdf)
+                try:
+                    oids = record_ids(data["objectid"])
+                except (TypeError, ValueError):
+                    return {"message": "error: 'objectid' must be a list of numbers"}, 400
 
-                # pull records from db as list of dictionaries
-                records = ef.retrieve_from_postgis(dbase, dbase['table'], data['objectid'])
+                # get the records corresponding with requested objectids and load them into postgres, batched
+                # with any other refreshes requested at the same time (see refresh_records)
+                records = refresh(oids)
 
                 # return records and/or message
-                return {
-                    "message": f"success: refreshed table {dbase['table']} for OBJECTID values {data['objectid']}",
-                    "count": len(records),
-                    "records": records
-                }
+                return Response(records_response(f"success: refreshed table {dbase['table']} for OBJECTID values {data['objectid']}", records), mimetype='application/json')
 
             else:
                 return {"message": "error: haven't developed handling for fields other than OBJECTID"}
 
+    # GET requests take the same 'fields', 'geometry' and 'resolution' args as the base route
     elif request.method == 'GET':
-        result = {
-            'OBJECTID': record.OBJECTID,
-            'ZONE_CMPLT': record.ZONE_CMPLT,
-            'ZONE_CLASS': record.ZONE_CLASS,
-            'ZONE_SMRY': record.ZONE_SMRY,
-            'Shape__Area': record.Shape__Area,
-            'Shape__Length': record.Shape__Length,
-            'timestamp': record.timestamp,
-        }
-        return{"message": f"success: retrieved record corresponding with OBJECTID {record_id}", "record": result}
+        try:
+            read = dict(read_args(request.args), oid_list=[oid])
+        except (TypeError, ValueError) as e:
+            return {"message": f"error: {e}"}, 400
+
+        def render():
+            records = list(ef.json_records(dbase, dbase['table'], **read))
+
+            # if the record_id isn't in the db, it cannot have a webpage
+            if not records:
+                abort(404)
+
+            return f'{{"message": {json.dumps(f"success: retrieved record corresponding with OBJECTID {record_id}")}, "record": {records[0]}}}'
+
+        return cached_get(render)
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
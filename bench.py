@@ -0,0 +1,202 @@
+"""
+benchmark suite for the etl functions and the flask api.
+serves a synthetic layer from a local fake ArcGIS FeatureServer (see bench_functions.py), times
+fetching, decoding, loading, updating and reading it back, then times the api's routes, reporting
+rows/sec, p50/p99 latency and peak rss for each stage. the 'capped fetch' stages also check
+that no records go missing when max_records is above the service's own page cap.
+
+database stages (and the routes) need a local postgis database, named by a database dict in
+etl_params.py, e.g. `python bench.py --db bench_db`. its table is replaced on every run, so don't
+point it at a table you care about. without --db, only the fetch stages run.
+
+results can be saved as a baseline (--save) and later runs compared against it (--baseline),
+listing the stages that got slower or hungrier than the baseline by more than --tolerance:
+    python bench.py --rows 50000 --db bench_db --save bench_baseline.json
+    python bench.py --rows 50000 --db bench_db --baseline bench_baseline.json
+"""
+
+import sys
+import math
+import random
+import argparse
+import etl_functions as ef
+import bench_functions as bf
+
+
+def fetch_stages(server, args) -> list:
+    """
+    times fetching the fake layer: paging it sequentially and with workers, refreshing a
+    sample of ids, and decoding a single page
+    """
+    sample = sorted(random.Random(0).sample(range(1, args.rows + 1), min(args.sample, args.rows)))
+    page = ef.mk_session(server.endpoint()).get(ef.query_url(server.endpoint()), params=ef.query_params(server.endpoint())).content
+
+    return [
+        bf.measure('decode page (features_to_gdf)', lambda: ef.features_to_gdf(ef.json_loads(page), page), repeat=args.repeat * 10, warmup=1),
+        bf.measure('ags_to_gdf (sequential)', lambda: ef.ags_to_gdf(server.endpoint()), repeat=args.repeat),
+        bf.measure(f'ags_to_gdf ({args.workers} workers)', lambda: ef.ags_to_gdf(server.endpoint(workers=args.workers)), repeat=args.repeat),
+        bf.measure(f'oids_to_gdf ({len(sample)} ids)', lambda: ef.oids_to_gdf(server.endpoint(workers=args.workers), sample), repeat=args.repeat),
+    ]
+
+def capped_stages(args) -> list:
+    """
+    fetches the fake layer with max_records set above the fake service's cap (as when a
+    layer's maxRecordCount is lower than configured), from a service with an id list and
+    from one without (paged by record count), raising an exception if any records go missing
+    """
+    def complete(fn):
+        def call():
+            rows = len(fn())
+
+            if rows != args.rows:
+                raise Exception(f'{args.rows - rows} of {args.rows} records went missing')
+
+            return rows
+
+        return call
+
+    stages = []
+
+    for ids in (True, False):
+        with bf.FakeFeatureServer(rows=args.rows, max_records=args.page_size, ids=ids) as server:
+            source = 'ids' if ids else 'count'
+            endpoint = lambda **options: server.endpoint(max_records=args.page_size * 2, **options)
+
+            stages += [
+                bf.measure(f'capped fetch ({source})', complete(lambda: ef.ags_to_gdf(endpoint()))),
+                bf.measure(f'capped fetch ({source}, {args.workers}w)', complete(lambda: ef.ags_to_gdf(endpoint(workers=args.workers)))),
+            ]
+
+    return stages
+
+def db_stages(server, database, args) -> list:
+    """
+    times loading the fake layer into postgis, updating a sample of it, and reading it back
+    """
+    table = database['table']
+    source = server.endpoint(workers=args.workers)
+    sample = sorted(random.Random(1).sample(range(1, args.rows + 1), min(args.sample, args.rows)))
+    gdf = ef.oids_to_gdf(source, sample)
+
+    def update():
+        ef.update_with_gdf(database, table, gdf)
+        return len(gdf)
+
+    return [
+        bf.measure('pages_to_postgis', lambda: ef.pages_to_postgis(database, table, ef.ags_pages(source), if_exists='replace'), repeat=args.repeat),
+        bf.measure(f'update_with_gdf ({len(gdf)} rows)', update, repeat=args.repeat),
+        bf.measure(f'retrieve_from_postgis ({len(sample)} ids)', lambda: ef.retrieve_from_postgis(database, table, sample), repeat=args.repeat),
+        bf.measure('read_pages', lambda: sum(len(p) for p in ef.read_pages(database, table)), repeat=args.repeat),
+    ]
+
+def route_stages(server, database, args) -> list:
+    """
+    times the api's routes with flask's test client, against the table loaded by db_stages.
+    the caches are cleared before each request (except for the 'cached' stage), so the
+    numbers reflect the work behind a response rather than cache hits.
+    """
+    import etl_params as ep
+
+    # point the api at the benchmark database and the fake server before it's imported
+    ep.postgres1 = database
+    ep.zoning = server.endpoint(workers=args.workers)
+
+    import app as api
+
+    client = api.app.test_client()
+    oid = args.rows // 2
+
+    # the tile over the middle of the fake layer
+    z = 15
+    lon, lat = -122.75 + 0.0005 * math.sqrt(args.rows), 45.45 + 0.0005 * math.sqrt(args.rows)
+    x = int((lon + 180) / 360 * 2 ** z)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * 2 ** z)
+
+    def get(url, rows, cached=False):
+        def call():
+            if not cached:
+                api.response_cache.clear()
+                api.tile_cache.clear()
+
+            response = client.get(url)
+
+            if response.status_code != 200:
+                raise Exception(f'{url} returned {response.status_code}')
+
+            return rows(response)
+
+        return call
+
+    def post(url, ids):
+        def call():
+            response = client.post(url, json={"objectid": ids})
+
+            if response.status_code != 200:
+                raise Exception(f'{url} returned {response.status_code}')
+
+            return len(ids)
+
+        return call
+
+    count = lambda response: response.get_json()["count"]
+    one = lambda response: 1
+    bbox = f'{lon - 0.01},{lat - 0.01},{lon + 0.01},{lat + 0.01}'
+
+    return [
+        bf.measure('GET /', get('/', count), repeat=args.repeat),
+        bf.measure('GET / (cached)', get('/', count, cached=True), repeat=args.repeat, warmup=1),
+        bf.measure('GET /?limit=500', get('/?limit=500', count), repeat=args.requests),
+        bf.measure('GET /<id>', get(f'/{oid}', one), repeat=args.requests),
+        bf.measure('GET /query (bbox)', get(f'/query?bbox={bbox}', lambda response: len(response.get_json()["features"])), repeat=args.requests),
+        bf.measure('GET /tiles (z15)', get(f'/tiles/{z}/{x}/{y}.mvt', one), repeat=args.requests),
+        bf.measure('GET /export/parquet', get('/export/parquet', lambda response: args.rows), repeat=args.repeat),
+        bf.measure('POST /<id>', post(f'/{oid}', [oid]), repeat=args.requests),
+        bf.measure(f'POST / ({args.sample} ids)', post('/', list(range(1, args.sample + 1))), repeat=args.repeat),
+    ]
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='benchmark the etl and api against a local fake feature service')
+    parser.add_argument('--rows', type=int, default=20000, help='features in the fake layer')
+    parser.add_argument('--page-size', type=int, default=2000, help="the fake service's max record count")
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds added to every fake service request')
+    parser.add_argument('--workers', type=int, default=4, help='fetch threads for the concurrent stages')
+    parser.add_argument('--sample', type=int, default=1000, help='ids refreshed/retrieved by the id-list stages')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each bulk stage')
+    parser.add_argument('--requests', type=int, default=50, help='requests made to each small route')
+    parser.add_argument('--db', help='name of the database dict in etl_params.py to benchmark against')
+    parser.add_argument('--no-routes', action='store_true', help='skip the api routes')
+    parser.add_argument('--baseline', help='baseline file to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a stage counts as a regression')
+    parser.add_argument('--save', help='file to save the results to, as a new baseline')
+    args = parser.parse_args(argv)
+
+    print(f'serving {args.rows} fake features ({args.page_size} per page, {args.latency}s latency)')
+
+    results = capped_stages(args)
+
+    with bf.FakeFeatureServer(rows=args.rows, max_records=args.page_size, latency=args.latency) as server:
+        results += fetch_stages(server, args)
+
+        if args.db:
+            import etl_params as ep
+
+            database = getattr(ep, args.db)
+
+            results += db_stages(server, database, args)
+
+            if not args.no_routes:
+                results += route_stages(server, database, args)
+
+    regressions = bf.compare(results, bf.load_baseline(args.baseline), args.tolerance) if args.baseline else []
+
+    print()
+    print(bf.report(results, regressions))
+
+    if args.save:
+        bf.save_baseline(results, args.save, vars(args))
+        print(f'\nresults saved to {args.save}')
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+"""
+Functions used by bench.py to benchmark the ETL and the flask api.
+
+FakeFeatureServer stands in for an ArcGIS FeatureServer on localhost, serving a synthetic
+zoning layer as paginated geojson, with a configurable size, page size and latency.
+measure() times a stage, and compare() checks a run's results against a saved baseline.
+"""
+
+import re
+import sys
+import json
+import hashlib
+import time
+import random
+import platform
+import threading
+from datetime import datetime as dt
+from urllib.parse import urlparse, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+ZONES = [
+    ('R5', 'Residential 5,000', 'Single-Dwelling Residential'),
+    ('R2.5', 'Residential 2,500', 'Single-Dwelling Residential'),
+    ('RM2', 'Residential Multi-Dwelling 2', 'Multi-Dwelling Residential'),
+    ('CM2', 'Commercial/Mixed Use 2', 'Commercial'),
+    ('EG1', 'General Employment 1', 'Employment'),
+    ('IH', 'Heavy Industrial', 'Industrial'),
+    ('OS', 'Open Space', 'Open Space'),
+]
+
+# comparisons against the OBJECTID field in a where clause, e.g. "OBJECTID >= 2001"
+WHERE_EXP = re.compile(r'(\w+)\s*(>=|<=|<>|=|>|<)\s*(\d+)')
+
+
+class FakeFeatureServer:
+    """
+    serves a synthetic polygon layer of rows features (OBJECTIDs 1..rows, a grid of small
+    squares with the zoning fields the api's model expects) at
+    http://127.0.0.1:<port>/arcgis/rest/services/<service>/FeatureServer/<layer>/query
+
+    the query endpoint understands what the fetch functions send: where clauses made of
+    OBJECTID comparisons (anything else matches every feature), objectIds, returnIdsOnly,
+    returnCountOnly, resultOffset/resultRecordCount, returnGeometry and POSTed forms.
+    pages hold at most max_records features, and every request is delayed by latency seconds.
+    with etag=True, responses carry an ETag, and requests sending a matching If-None-Match
+    get an empty 304. with ids=False, returnIdsOnly queries get no id list (like services
+    that don't support it), so the fetch functions fall back to paging by record count.
+
+    use as a context manager; endpoint() returns a data source dict pointing at the server.
+    """
+
+    def __init__(self, rows:int=10000, max_records:int=2000, latency:float=0.0, seed:int=0, edit_field:str=None,
+                 etag:bool=False, ids:bool=True):
+        self.rows = rows
+        self.max_records = max_records
+        self.latency = latency
+        self.edit_field = edit_field
+        self.etag = etag
+        self.ids = ids
+        self.requests = 0  # requests answered
+
+        rng = random.Random(seed)
+        now = int(dt.timestamp(dt.now()) * 1000)
+        side = int(rows ** 0.5) + 1
+
+        # serialize every feature once, so serving a page is mostly joining strings
+        self.features = []
+
+        for oid in range(1, rows + 1):
+            x = -122.75 + (oid % side) * 0.001
+            y = 45.45 + (oid // side) * 0.001
+            d = 0.0009
+            code, complete, summary = rng.choice(ZONES)
+
+            properties = {
+                "OBJECTID": oid,
+                "ZONE_CMPLT": complete,
+                "ZONE_CLASS": code,
+                "ZONE_SMRY": summary,
+                "Shape__Area": 8000 + rng.random() * 2000,
+                "Shape__Length": 360 + rng.random() * 40,
+            }
+
+            if edit_field:
+                properties[edit_field] = now - rng.randrange(365 * 86400) * 1000
+
+            self.features.append((
+                json.dumps({"type": "Feature", "id": oid, "properties": properties})[:-1],
+                json.dumps({"type": "Polygon", "coordinates": [[[x, y], [x + d, y], [x + d, y + d], [x, y + d], [x, y]]]}),
+            ))
+
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self) -> None:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like a real server
+
+            def do_GET(self):
+                self.answer(urlparse(self.path).query)
+
+            def do_POST(self):
+                self.answer(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+
+            def answer(self, query):
+                if not re.search(r'/FeatureServer/\d+/query$', urlparse(self.path).path):
+                    status, body = 404, b'{"error": {"code": 404, "message": "not found"}}'
+                else:
+                    status, body = 200, server.query(dict(parse_qsl(query)))
+
+                if server.latency:
+                    time.sleep(server.latency)
+
+                etag = f'"{hashlib.md5(body).hexdigest()}"' if server.etag and status == 200 else None
+
+                if etag is not None and self.headers.get('If-None-Match') == etag:
+                    status, body = 304, b''
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+
+                if etag is not None:
+                    self.send_header('ETag', etag)
+
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def endpoint(self, **options) -> dict:
+        """
+        returns a data source dict for the running server (see etl_params.py), with any
+        extra keys (e.g. workers) given as options
+        """
+        endpoint = {
+            "host": f'127.0.0.1:{self._server.server_address[1]}',
+            "scheme": "http",
+            "service": "Bench/Zoning",
+            "service_type": "FeatureServer",
+            "layer_id": 0,
+            "format": "geojson",
+            "max_records": self.max_records,
+        }
+
+        if self.edit_field:
+            endpoint["edit_field"] = self.edit_field
+
+        endpoint.update(options)
+
+        return endpoint
+
+    def query(self, params:dict) -> bytes:
+        """
+        answers a query request (params as sent by the fetch functions) with a json body
+        """
+        self.requests += 1
+
+        if params.get('objectIds'):
+            oids = [int(i) for i in params['objectIds'].split(',') if i.strip()]
+            oids = [i for i in oids if 1 <= i <= self.rows]
+        else:
+            oids = self.where(params.get('where', '1=1'))
+
+        if params.get('returnIdsOnly') == 'true':
+            return json.dumps({"objectIdFieldName": "OBJECTID", "objectIds": oids if self.ids else None}).encode()
+
+        if params.get('returnCountOnly') == 'true':
+            return json.dumps({"count": len(oids)}).encode()
+
+        offset = int(params.get('resultOffset', 0))
+        count = min(int(params.get('resultRecordCount', self.max_records)), self.max_records)
+        page = oids[offset:offset + count]
+        geometry = params.get('returnGeometry', 'true') != 'false'
+
+        features = ','.join(
+            f'{self.features[i - 1][0]}, "geometry": {self.features[i - 1][1] if geometry else "null"}}}'
+            for i in page
+        )
+        exceeded = 'true' if offset + count < len(oids) else 'false'
+
+        return f'{{"type": "FeatureCollection", "features": [{features}], "properties": {{"exceededTransferLimit": {exceeded}}}}}'.encode()
+
+    def where(self, clause:str) -> list:
+        """
+        returns the OBJECTIDs matching the OBJECTID comparisons in a where clause
+        """
+        oids = range(1, self.rows + 1)
+        lo, hi, skip = 1, self.rows, set()
+
+        for field, op, value in WHERE_EXP.findall(clause):
+            if field.upper() != 'OBJECTID':
+                continue
+
+            value = int(value)
+
+            if op == '>=':
+                lo = max(lo, value)
+            elif op == '>':
+                lo = max(lo, value + 1)
+            elif op == '<=':
+                hi = min(hi, value)
+            elif op == '<':
+                hi = min(hi, value - 1)
+            elif op == '=':
+                lo, hi = max(lo, value), min(hi, value)
+            else:
+                skip.add(value)
+
+        return [i for i in oids[lo - 1:hi] if i not in skip]
+
+
+def peak_rss_mb() -> float:
+    """
+    returns the process's peak resident set size in MB (None where unsupported)
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # linux reports kilobytes, macos bytes
+    return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+def percentile(values:list, q:float) -> float:
+    """
+    returns the q-th percentile (0-100) of values, by nearest rank
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(q / 100 * len(values))) - 1))]
+
+def measure(name:str, fn, repeat:int=1, warmup:int=0) -> dict:
+    """
+    calls fn() repeat times (after warmup untimed calls) and returns the stage's results:
+    rows processed per call (fn's return value: a row count, or anything with a len),
+    rows/sec over all calls, p50/p99 call latency, and the process's peak rss after the
+    stage along with how much the stage raised it.
+    """
+    for _ in range(warmup):
+        fn()
+
+    rss_before = peak_rss_mb()
+    times = []
+    rows = 0
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+
+        rows += result if isinstance(result, int) else len(result)
+
+    rss_after = peak_rss_mb()
+    total = sum(times)
+
+    return {
+        "stage": name,
+        "calls": repeat,
+        "rows": rows // repeat,
+        "seconds": round(total, 4),
+        "rows_per_sec": round(rows / total, 1) if total else None,
+        "p50_ms": round(percentile(times, 50) * 1000, 2),
+        "p99_ms": round(percentile(times, 99) * 1000, 2),
+        "peak_rss_mb": rss_after,
+        "rss_growth_mb": round(rss_after - rss_before, 1) if rss_after is not None else None,
+    }
+
+def save_baseline(results:list, path:str, settings:dict=None) -> None:
+    """
+    writes a run's results (and the settings it ran with) to a json baseline file
+    """
+    with open(path, 'w') as f:
+        json.dump({
+            "created": dt.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": settings or {},
+            "results": results,
+        }, f, indent=2)
+
+def load_baseline(path:str) -> dict:
+    """
+    reads a baseline file written by save_baseline
+    """
+    with open(path) as f:
+        return json.load(f)
+
+def compare(results:list, baseline:dict, tolerance:float=0.2) -> list:
+    """
+    compares results with a baseline's, stage by stage, returning a list of regressions:
+    (stage, metric, baseline value, current value) for each rows/sec that fell, or p99 or
+    peak rss growth that rose, by more than tolerance (a fraction of the baseline value)
+    """
+    regressions = []
+    before = {r["stage"]: r for r in baseline["results"]}
+
+    for result in results:
+        old = before.get(result["stage"])
+
+        if old is None:
+            continue
+
+        for metric, worse in (('rows_per_sec', -1), ('p99_ms', 1), ('rss_growth_mb', 1)):
+            a, b = old.get(metric), result.get(metric)
+
+            if a is None or b is None:
+                continue
+
+            # ignore noise in tiny values (e.g. a stage that barely moves rss)
+            if metric == 'rss_growth_mb' and max(a, b) < 10:
+                continue
+
+            if worse * (b - a) > tolerance * abs(a):
+                regressions.append((result["stage"], metric, a, b))
+
+    return regressions
+
+def report(results:list, regressions:list=None) -> str:
+    """
+    formats results (and any regressions found by compare) as a text table
+    """
+    lines = [f'{"stage":<32}{"rows":>9}{"rows/sec":>12}{"p50 ms":>10}{"p99 ms":>10}{"rss MB":>9}{"+rss":>7}']
+
+    for r in results:
+        lines.append(
+            f'{r["stage"]:<32}{r["rows"]:>9}{r["rows_per_sec"] or 0:>12.1f}{r["p50_ms"]:>10.2f}{r["p99_ms"]:>10.2f}'
+            f'{r["peak_rss_mb"] or 0:>9.1f}{r["rss_growth_mb"] or 0:>7.1f}'
+        )
+
+    if regressions:
+        lines.append('')
+        lines.append('regressions:')
+
+        for stage, metric, a, b in regressions:
+            lines.append(f'\t{stage}: {metric} {a} -> {b}')
+
+    return '\n'.join(lines)
@@ -0,0 +1,346 @@
+"""
+caches used by the flask api to avoid repeating database reads and serialization, and by
+the etl functions to avoid repeating downloads from arcgis.
+
+entries are keyed by strings and hold bytes (e.g. response bodies). see ResponseCache, and
+DiskCache for the etl's cache of raw arcgis responses.
+"""
+
+import os
+import gzip
+import json
+import math
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from threading import Lock
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+log = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    in-process LRU cache with a per-entry time-to-live, bounded by entry count and
+    (optionally) total size in bytes. if a redis url is given, entries are also written
+    to redis, so several api processes can share them; redis is only consulted on a
+    local miss.
+
+    dependencies: redis (only if redis_url is used)
+    """
+
+    def __init__(self, max_entries:int=256, ttl:float=300, max_bytes:int=None, redis_url:str=None, prefix:str='cache'):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.size = 0  # total bytes held locally
+
+        self._entries = OrderedDict()  # key -> (expiry, value), least recently used first
+        self._lock = Lock()
+
+        if redis_url:
+            if redis is None:
+                raise ImportError('a cache url was configured, but the redis package is not installed')
+
+            self._redis = redis.Redis.from_url(redis_url)
+        else:
+            self._redis = None
+
+    def get(self, key:str) -> bytes:
+        """
+        returns the cached value for key, or None if it's missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                expiry, value = entry
+
+                if expiry > time.monotonic():
+                    self._entries.move_to_end(key)
+                    return value
+
+                self._remove(key)
+
+        if self._redis is not None:
+            value = self._redis.get(f'{self.prefix}:{key}')
+
+            if value is not None:
+                self.set(key, value, shared=False)
+
+            return value
+
+        return None
+
+    def set(self, key:str, value:bytes, ttl:float=None, shared:bool=True) -> None:
+        """
+        stores value under key for ttl seconds (defaults to the cache's ttl), evicting the
+        least recently used entries until the cache is back within its limits.
+        values larger than max_bytes are not cached.
+        """
+        ttl = ttl or self.ttl
+
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self.size += len(value)
+
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+        if shared and self._redis is not None:
+            self._redis.set(f'{self.prefix}:{key}', value, ex=int(ttl))
+
+    def tee(self, key:str, chunks, max_size:int=None):
+        """
+        passes an iterable of str/bytes chunks through (e.g. a streamed response body),
+        caching the joined value under key once it's complete. bodies that grow beyond
+        max_size bytes (or the cache's max_bytes) are streamed without being cached.
+        """
+        parts = []
+        size = 0
+
+        if self.max_bytes is not None:
+            max_size = min(max_size or self.max_bytes, self.max_bytes)
+
+        for chunk in chunks:
+            yield chunk
+
+            if parts is not None:
+                part = chunk.encode() if isinstance(chunk, str) else chunk
+                parts.append(part)
+                size += len(part)
+
+                if max_size is not None and size > max_size:
+                    parts = None
+
+        if parts is not None:
+            self.set(key, b''.join(parts))
+
+    def invalidate(self, predicate) -> int:
+        """
+        removes the local entries whose key satisfies predicate(key), returning how many
+        were removed (shared entries expire on their own, since keys carry a table version)
+        """
+        with self._lock:
+            keys = [k for k in self._entries if predicate(k)]
+
+            for k in keys:
+                self._remove(k)
+
+        return len(keys)
+
+    def clear(self) -> None:
+        """
+        removes every local entry
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key:str) -> None:
+        # callers hold the lock
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class TileCache(ResponseCache):
+    """
+    size-bounded cache of vector tiles, keyed 'z/x/y' (optionally followed by '@<variant>',
+    e.g. a geometry resolution). besides the ResponseCache methods, it can drop just the
+    tiles that overlap areas a refresh touched (see invalidate_boxes).
+    """
+
+    @staticmethod
+    def tile_bounds(z:int, x:int, y:int) -> tuple:
+        """
+        returns the wgs84 bounds (xmin, ymin, xmax, ymax) of a web mercator (xyz) tile
+        """
+        n = 2 ** z
+
+        def lat(row):
+            return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+        return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+    def invalidate_boxes(self, boxes) -> int:
+        """
+        removes the cached tiles that overlap any of the given wgs84 boxes
+        (xmin, ymin, xmax, ymax), returning how many were removed
+        """
+        boxes = [b for b in boxes if b is not None]
+
+        def overlaps(key):
+            txmin, tymin, txmax, tymax = self.tile_bounds(*(int(i) for i in key.split('@')[0].split('/')))
+
+            return any(
+                xmin <= txmax and xmax >= txmin and ymin <= tymax and ymax >= tymin
+                for xmin, ymin, xmax, ymax in boxes
+            )
+
+        return self.invalidate(overlaps)
+
+
+class DiskCache:
+    """
+    on-disk cache of http response bodies (the etl's arcgis responses, see
+    etl_functions.ags_query), keyed by the normalized request (see key). each body is
+    stored gzipped, next to a json header holding the response headers needed to revalidate
+    it with the server (ETag, Last-Modified) and when it was stored.
+
+    once the bodies take up more than max_bytes, the least recently used entries are
+    evicted. entries are files, so the cache outlives the process and can be shared by runs.
+    """
+
+    def __init__(self, directory:str, max_bytes:int=2 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = None  # total bytes of stored bodies, counted on first write
+
+        self._lock = Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(method:str, url:str, params:dict=None) -> str:
+        """
+        returns the cache key of a request: a hash of its method, its url (lowercased scheme
+        and host) and its query parameters, sorted, wherever they were given (in the url's
+        query string or in params)
+        """
+        parts = urlsplit(url)
+        query = sorted(parse_qsl(parts.query, keep_blank_values=True) + [(str(k), str(v)) for k, v in (params or {}).items()])
+        normalized = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, urlencode(query), ''))
+
+        return hashlib.sha1(f'{method.upper()} {normalized}'.encode()).hexdigest()
+
+    def _path(self, key:str, suffix:str) -> str:
+        return os.path.join(self.directory, key[:2], f'{key}{suffix}')
+
+    def get(self, key:str) -> tuple:
+        """
+        returns (body, header) for key, or None if it isn't cached. the header is a dict
+        with the stored response "headers" and the time the entry was "stored".
+        """
+        try:
+            with open(self._path(key, '.json')) as f:
+                header = json.load(f)
+
+            with gzip.open(self._path(key, '.gz')) as f:
+                body = f.read()
+
+        except (OSError, ValueError, EOFError):
+            return None
+
+        self.touch(key)
+
+        return body, header
+
+    def _write(self, key:str, suffix:str, content:bytes) -> None:
+        # write to a temporary file first, so a reader never sees a partial entry
+        tmp = self._path(key, f'{suffix}.{os.getpid()}.{id(content)}.tmp')
+
+        with open(tmp, 'wb') as f:
+            f.write(content)
+
+        os.replace(tmp, self._path(key, suffix))
+
+    def touch(self, key:str) -> None:
+        """
+        marks an entry as just used, so it's evicted last
+        """
+        try:
+            os.utime(self._path(key, '.gz'))
+        except OSError:
+            pass
+
+    def revalidated(self, key:str, header:dict) -> None:
+        """
+        records that the server confirmed an entry (with the header get returned) is still
+        current, restarting its age
+        """
+        self._write(key, '.json', json.dumps(dict(header, stored=time.time())).encode())
+
+    def set(self, key:str, body:bytes, headers:dict=None) -> None:
+        """
+        stores a response body under key, along with the response headers that let it be
+        revalidated later, then evicts old entries if the cache has outgrown max_bytes
+        """
+        validators = {'etag': 'ETag', 'last-modified': 'Last-Modified'}
+        header = {"stored": time.time(), "headers": {validators[k.lower()]: v for k, v in (headers or {}).items() if k.lower() in validators}}
+        data = gzip.compress(body, compresslevel=1)
+
+        os.makedirs(os.path.dirname(self._path(key, '.gz')), exist_ok=True)
+
+        self._write(key, '.gz', data)
+        self._write(key, '.json', json.dumps(header).encode())
+
+        with self._lock:
+            if self.size is None:
+                self.size = sum(size for _, size, _ in self._entries())
+            else:
+                self.size += len(data)
+
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> list:
+        # (key, size, last used) of every stored body
+        entries = []
+
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.gz'):
+                    stat = os.stat(os.path.join(root, name))
+                    entries.append((name[:-3], stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def _evict(self) -> None:
+        # callers hold the lock. removes the least recently used entries until the cache is
+        # back under 90% of max_bytes, so that evicting isn't needed again on the next write
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.size = sum(size for _, size, _ in entries)
+        removed = 0
+
+        for key, size, _ in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+
+            for suffix in ('.gz', '.json'):
+                try:
+                    os.remove(self._path(key, suffix))
+                except OSError:
+                    pass
+
+            self.size -= size
+            removed += 1
+
+        log.info('evicted %s responses from %s (%s bytes kept)', removed, self.directory, self.size)
+
+    def clear(self) -> None:
+        """
+        removes every entry
+        """
+        with self._lock:
+            for key, _, _ in self._entries():
+                for suffix in ('.gz', '.json'):
+                    try:
+                        os.remove(self._path(key, suffix))
+                    except OSError:
+                        pass
+
+            self.size = 0
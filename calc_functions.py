@@ -1,3 +1,346 @@
 """
 Functions used to perform real estate analysis on geopandas dataframes
-"""
\ No newline at end of file
+
+the zoning aggregates (area and length totals by zone, parcel/zone overlays and per-zone
+coverage) work on whole arrays of geometries at once with shapely 2, using an STRtree to pair
+parcels with the zones they touch. each aggregate has an _sql twin that runs the same thing
+in postgis against loaded tables, so nothing has to be read into python first.
+
+areas are in square meters and lengths in meters: geodataframes are measured in a projected
+crs (by default, the utm zone they fall in) and postgis measures on the spheroid (as
+geography) unless it's given an srid to project to.
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from psycopg2 import sql
+import etl_functions as ef
+import metrics_functions as mf
+
+
+log = logging.getLogger(__name__)
+
+# the aggregates use shapely 2's array functions (shapely.area, make_valid, STRtree.query on arrays)
+if not hasattr(shapely, 'area'):
+    raise ImportError(f'calc_functions requires shapely 2 or newer (found {shapely.__version__})')
+
+# fields the zoning layer is summarized by, unless told otherwise
+ZONE_FIELDS = ['ZONE_CLASS', 'ZONE_SMRY']
+
+
+def measuring_crs(gdf:gpd.GeoDataFrame):
+    """
+    returns the crs a gdf's geometries are measured in: its own if it's projected (or
+    unknown), otherwise the utm zone it falls in
+
+    dependencies: geopandas as gpd
+    """
+    if gdf.crs is None or not gdf.crs.is_geographic or gdf.empty:
+        return gdf.crs
+
+    return gdf.estimate_utm_crs()
+
+def projected(gdf:gpd.GeoDataFrame, crs=None) -> np.ndarray:
+    """
+    returns a gdf's geometries as an array of shapely geometries in crs (if given), with any
+    invalid ones repaired so that overlays don't fail on them
+
+    dependencies: shapely, numpy as np
+    """
+    geoms = gdf.geometry
+
+    if crs is not None and gdf.crs is not None and gdf.crs != crs:
+        geoms = geoms.to_crs(crs)
+
+    geoms = np.array(geoms.array, dtype=object)
+    invalid = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+
+    if invalid.any():
+        log.debug('repairing %s invalid geometries', invalid.sum())
+        geoms[invalid] = shapely.make_valid(geoms[invalid])
+
+    return geoms
+
+def zone_totals(gdf:gpd.GeoDataFrame, by:list=None, crs=None) -> pd.DataFrame:
+    """
+    totals a zoning gdf by the by fields (default ZONE_FIELDS): the number of features in
+    each group, their area (m²) and length (m, the perimeter of polygons), and the group's
+    share of the total area. groups are sorted largest first.
+
+    dependencies: shapely, pandas as pd
+    """
+    by = list(by or ZONE_FIELDS)
+
+    with mf.stage('analyze', op='zone_totals') as counts:
+        geoms = projected(gdf, crs or measuring_crs(gdf))
+
+        df = pd.DataFrame({f: gdf[f].to_numpy() for f in by})
+        df['count'] = 1
+        df['area'] = shapely.area(geoms)
+        df['length'] = shapely.length(geoms)
+
+        counts["rows"] = len(df)
+
+        return shares(df.groupby(by, dropna=False)[['count', 'area', 'length']].sum().reset_index())
+
+def shares(totals:pd.DataFrame) -> pd.DataFrame:
+    """
+    adds each group's share of the total area to a table of totals, sorted largest first
+    """
+    area = totals['area'].sum()
+    totals['share'] = totals['area'] / area if area else 0.0
+
+    return totals.sort_values('area', ascending=False, ignore_index=True)
+
+def combine_totals(totals:list, by:list=None) -> pd.DataFrame:
+    """
+    combines zone_totals tables (e.g. one per page of a layer) into totals for the whole
+    """
+    by = list(by or ZONE_FIELDS)
+    totals = [t for t in totals if not t.empty]
+
+    if not totals:
+        return pd.DataFrame(columns=by + ['count', 'area', 'length', 'share'])
+
+    combined = pd.concat(totals, ignore_index=True).groupby(by, dropna=False)[['count', 'area', 'length']].sum()
+
+    return shares(combined.reset_index())
+
+def tally_pages(pages, totals:list, by:list=None, crs=None):
+    """
+    passes pages (geodataframes, e.g. from etl_functions.ags_pages) through unchanged,
+    appending each one's zone_totals to totals on the way, so a layer can be summarized
+    while it's loaded without holding it in memory (see combine_totals).
+    every page is measured in the same crs: crs, or the one picked for the first page.
+    """
+    for page in pages:
+        if not page.empty:
+            crs = crs or measuring_crs(page)
+            totals.append(zone_totals(page, by, crs))
+
+        yield page
+
+def overlay_zones(parcels:gpd.GeoDataFrame, zones:gpd.GeoDataFrame, zone_fields:list=None, parcel_fields:list=None,
+                  crs=None) -> gpd.GeoDataFrame:
+    """
+    intersects parcels with zones, returning one row per parcel/zone overlap: the parcel
+    (its index in parcels, as 'parcel', plus any parcel_fields), the zone's zone_fields
+    (default ZONE_FIELDS), the piece of the parcel in the zone (geometry, in crs), its area
+    (m²) and its share of the parcel's area. overlaps with no area (parcels that only touch
+    a zone's edge) are left out.
+
+    candidate pairs come from an STRtree over the zones, queried with every parcel at once;
+    parcels that lie wholly inside a zone keep their own geometry rather than being cut.
+
+    dependencies: shapely, geopandas as gpd, numpy as np
+    """
+    zone_fields = list(zone_fields or ZONE_FIELDS)
+    parcel_fields = list(parcel_fields or [])
+    crs = crs or measuring_crs(parcels)
+
+    with mf.stage('analyze', op='overlay') as counts:
+        p = projected(parcels, crs)
+        z = projected(zones, crs)
+
+        pi, zi = shapely.STRtree(z).query(p, predicate='intersects')
+
+        pieces = p[pi]
+        cut = ~shapely.contains_properly(z[zi], pieces)
+        pieces[cut] = shapely.intersection(pieces[cut], z[zi][cut])
+
+        area = shapely.area(pieces)
+        whole = shapely.area(p[pi])
+
+        columns = {'parcel': parcels.index.to_numpy()[pi]}
+        columns.update({f: parcels[f].to_numpy()[pi] for f in parcel_fields})
+        columns.update({f: zones[f].to_numpy()[zi] for f in zone_fields})
+        columns['area'] = area
+        columns['share'] = np.divide(area, whole, out=np.zeros_like(area), where=whole > 0)
+
+        keep = area > 0
+        overlay = gpd.GeoDataFrame({k: v[keep] for k, v in columns.items()}, geometry=pieces[keep], crs=crs)
+
+        counts["rows"] = len(overlay)
+
+    return overlay
+
+def parcel_zones(parcels:gpd.GeoDataFrame, zones:gpd.GeoDataFrame, zone_fields:list=None, crs=None) -> pd.DataFrame:
+    """
+    returns the zone each parcel is mostly in: the zone_fields (default ZONE_FIELDS) of the
+    zone covering the largest part of it, and the share of the parcel it covers, indexed like
+    parcels. parcels outside every zone are left out.
+
+    dependencies: pandas as pd
+    """
+    zone_fields = list(zone_fields or ZONE_FIELDS)
+    overlay = overlay_zones(parcels, zones, zone_fields, crs=crs)
+
+    dominant = overlay.sort_values('area', ascending=False).drop_duplicates('parcel').set_index('parcel')
+    dominant.index.name = parcels.index.name
+
+    return pd.DataFrame(dominant[zone_fields + ['share']]).sort_index()
+
+def zone_coverage(zones:gpd.GeoDataFrame, parcels:gpd.GeoDataFrame, by:list=None, crs=None) -> pd.DataFrame:
+    """
+    returns coverage stats per zone group (by fields, default ZONE_FIELDS): the zone_totals
+    of the group, the number of parcels that overlap it, the area of it covered by parcels
+    (m²), and coverage (covered area / zone area).
+
+    dependencies: pandas as pd
+    """
+    by = list(by or ZONE_FIELDS)
+    crs = crs or measuring_crs(zones)
+
+    totals = zone_totals(zones, by, crs)
+    overlay = overlay_zones(parcels, zones, by, crs=crs)
+
+    covered = overlay.groupby(by, dropna=False).agg(parcels=('parcel', 'nunique'), covered=('area', 'sum')).reset_index()
+    coverage = totals.merge(covered, on=by, how='left')
+
+    coverage['parcels'] = coverage['parcels'].fillna(0).astype(int)
+    coverage['covered'] = coverage['covered'].fillna(0.0)
+    coverage['coverage'] = (coverage['covered'] / coverage['area'].replace(0, np.nan)).fillna(0.0)
+
+    return coverage
+
+def measure_sql(fn:str, geometry, srid:int=None) -> sql.Composable:
+    """
+    returns the sql measuring a geometry expression with postgis function fn (ST_Area,
+    ST_Perimeter or ST_Length) in meters: on the spheroid, or after projecting to srid
+    """
+    if srid:
+        return sql.SQL('{}(ST_Transform({}, {}))').format(sql.SQL(fn), geometry, sql.Literal(int(srid)))
+
+    return sql.SQL('{}(({})::geography)').format(sql.SQL(fn), geometry)
+
+def read_frame(database:dict, exp, params:list=None, op:str=None) -> pd.DataFrame:
+    """
+    runs a query and returns its rows as a dataframe
+
+    dependencies: psycopg2, pandas as pd
+    """
+    with ef.pg_connect(database) as con, con.cursor() as cur, mf.stage('db_read', op=op or 'analyze') as counts:
+        cur.execute(exp, params or [])
+        rows = cur.fetchall()
+
+        counts["rows"] = len(rows)
+
+        return pd.DataFrame(rows, columns=[c[0] for c in cur.description])
+
+def zone_totals_sql(database:dict, table:str, by:list=None, srid:int=None) -> pd.DataFrame:
+    """
+    zone_totals, computed by postgis for a loaded zoning table
+
+    dependencies: psycopg2
+    """
+    by = list(by or ZONE_FIELDS)
+    geometry = sql.SQL('t.geometry')
+
+    exp = sql.SQL("""
+        SELECT {fields}, count(*) AS count, sum(area) AS area, sum(length) AS length,
+            coalesce(sum(area) / nullif(sum(sum(area)) OVER (), 0), 0) AS share
+        FROM (
+            -- shapely's length of a polygon is its perimeter, which ST_Length leaves at 0
+            SELECT {fields}, {area} AS area, {perimeter} + {length} AS length
+            FROM {target} AS t
+        ) AS m
+        GROUP BY {fields}
+        ORDER BY area DESC NULLS LAST;
+    """).format(
+        fields=sql.SQL(', ').join(sql.Identifier(f) for f in by),
+        area=measure_sql('ST_Area', geometry, srid),
+        perimeter=measure_sql('ST_Perimeter', geometry, srid),
+        length=measure_sql('ST_Length', geometry, srid),
+        target=sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(table))
+    )
+
+    return read_frame(database, exp, op='zone_totals')
+
+def overlap_sql(srid:int=None) -> sql.Composable:
+    """
+    returns the sql for the area of the overlap of parcel p and zone z (see overlay_zones)
+    """
+    piece = sql.SQL('CASE WHEN ST_ContainsProperly(z.geometry, p.geometry) THEN p.geometry ELSE ST_Intersection(p.geometry, z.geometry) END')
+
+    return measure_sql('ST_Area', piece, srid)
+
+def parcel_zones_sql(database:dict, parcels_table:str, zones_table:str, zone_fields:list=None, srid:int=None,
+                     parcel_id:str='OBJECTID') -> pd.DataFrame:
+    """
+    parcel_zones, computed by postgis for loaded parcel and zoning tables (in the database's
+    schema), indexed by the parcels' parcel_id field
+
+    dependencies: psycopg2, pandas as pd
+    """
+    zone_fields = list(zone_fields or ZONE_FIELDS)
+
+    exp = sql.SQL("""
+        SELECT DISTINCT ON (o.parcel) o.parcel, {fields}, o.area / nullif(o.whole, 0) AS share
+        FROM (
+            SELECT p.{parcel_id} AS parcel, {zone_fields}, {area} AS area, {whole} AS whole
+            FROM {parcels} AS p
+            JOIN {zones} AS z ON ST_Intersects(p.geometry, z.geometry)
+        ) AS o
+        WHERE o.area > 0
+        ORDER BY o.parcel, o.area DESC;
+    """).format(
+        fields=sql.SQL(', ').join(sql.SQL('o.{}').format(sql.Identifier(f)) for f in zone_fields),
+        zone_fields=sql.SQL(', ').join(sql.SQL('z.{}').format(sql.Identifier(f)) for f in zone_fields),
+        parcel_id=sql.Identifier(parcel_id),
+        area=overlap_sql(srid),
+        whole=measure_sql('ST_Area', sql.SQL('p.geometry'), srid),
+        parcels=sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(parcels_table)),
+        zones=sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(zones_table))
+    )
+
+    return read_frame(database, exp, op='parcel_zones').set_index('parcel')
+
+def zone_coverage_sql(database:dict, zones_table:str, parcels_table:str, by:list=None, srid:int=None,
+                      parcel_id:str='OBJECTID') -> pd.DataFrame:
+    """
+    zone_coverage, computed by postgis for loaded zoning and parcel tables (in the database's
+    schema). both need the GIST indexes made by etl_functions.ensure_spatial_index for the
+    overlay to be fast.
+
+    dependencies: psycopg2, pandas as pd
+    """
+    by = list(by or ZONE_FIELDS)
+    geometry = sql.SQL('z.geometry')
+
+    exp = sql.SQL("""
+        WITH totals AS (
+            SELECT {fields}, count(*) AS count, sum({area}) AS area, sum({perimeter} + {length}) AS length
+            FROM {zones} AS z
+            GROUP BY {fields}
+        ), covered AS (
+            SELECT {zone_fields}, count(DISTINCT p.{parcel_id}) AS parcels, sum({overlap}) AS covered
+            FROM {zones} AS z
+            JOIN {parcels} AS p ON ST_Intersects(p.geometry, z.geometry)
+            GROUP BY {zone_fields}
+        )
+        SELECT {total_fields}, t.count, t.area, t.length,
+            coalesce(t.area / nullif(sum(t.area) OVER (), 0), 0) AS share,
+            coalesce(c.parcels, 0) AS parcels,
+            coalesce(c.covered, 0) AS covered,
+            coalesce(c.covered / nullif(t.area, 0), 0) AS coverage
+        FROM totals AS t
+        LEFT JOIN covered AS c ON {join}
+        ORDER BY t.area DESC NULLS LAST;
+    """).format(
+        fields=sql.SQL(', ').join(sql.Identifier(f) for f in by),
+        zone_fields=sql.SQL(', ').join(sql.SQL('z.{}').format(sql.Identifier(f)) for f in by),
+        total_fields=sql.SQL(', ').join(sql.SQL('t.{}').format(sql.Identifier(f)) for f in by),
+        join=sql.SQL(' AND ').join(sql.SQL('t.{0} IS NOT DISTINCT FROM c.{0}').format(sql.Identifier(f)) for f in by),
+        area=measure_sql('ST_Area', geometry, srid),
+        perimeter=measure_sql('ST_Perimeter', geometry, srid),
+        length=measure_sql('ST_Length', geometry, srid),
+        overlap=overlap_sql(srid),
+        parcel_id=sql.Identifier(parcel_id),
+        zones=sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(zones_table)),
+        parcels=sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(parcels_table))
+    )
+
+    return read_frame(database, exp, op='zone_coverage')
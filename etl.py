@@ -4,9 +4,14 @@ draws functions from etl_functions.py and parameters from etl_params.py
 currently contains an example usage of ETL functions and parameters
 """
 
+import logging
 import etl_functions as ef
 import etl_params as ep
-import calc_functions as cf
+import export_functions as xf
+
+# show the etl functions' progress messages
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s: %(message)s')
+log = logging.getLogger('etl')
 
 # initialize db dictionary (from etl_params.py)
 db = ep.postgres1
@@ -14,16 +19,43 @@ db = ep.postgres1
 # initialize datasource dictionary (from etl_params.py)
 ds = ep.zoning
 
-# get some data from an arcgis rest endpoint
-d = ef.ags_to_gdf(ds)
+if ds.get('edit_field'):
+    # if the source has an edit-date field, only sync what changed since the last run
+    summary = ef.delta_sync(ds, db, db['table'], reconcile_deletes=True)
+    rows = summary['fetched']
+
+else:
+    # get some data from an arcgis rest endpoint, one page at a time
+    pages = ef.ags_pages(ds)
+
+    # optionally stage the pages on disk as geoparquet and load from there, so the table can be
+    # rebuilt later without re-fetching (set 'reuse_stage' to load the staged copy as-is)
+    if ds.get('stage_dir'):
+        if not ds.get('reuse_stage'):
+            xf.stage_pages(pages, ds['stage_dir'])
+
+        pages = xf.staged_pages(ds['stage_dir'])
+
+    # perform analysis with calc_functions: total up area and length by zone as the pages go by.
+    # it needs shapely 2, so without it the layer is still loaded, just not analyzed
+    try:
+        import calc_functions as cf
+    except ImportError as e:
+        log.warning('skipping the zone totals: %s', e)
+        cf = None
+
+    totals = []
+
+    if cf is not None:
+        pages = cf.tally_pages(pages, totals)
 
-# perform analysis with calc_functions
+    # stream the pages into postgres as they arrive (each page is written with COPY)
+    rows = ef.pages_to_postgis(db, db['table'], pages)
 
-# make a postgres engine and push data there
-engine = ef.mk_postgis_engine(db)
-d.to_postgis(db['table'], engine, db['schema'], if_exists=db['if_exists']) # this is a geopandas method
+    if cf is not None:
+        print(cf.combine_totals(totals).to_string(index=False))
 
-print(f'successful transmission to postgres\
+print(f'successful transmission of {rows} records to postgres\
         \n\ttable: {db["table"]}\
         \n\tschema: {db["schema"]}\
         \n\tdb: {db["database"]}')
@@ -0,0 +1,79 @@
+"""
+multi-source etl process.
+syncs every layer listed in etl_params.py concurrently, then prints (and optionally saves) a run summary.
+
+etl_params.py provides:
+    sync_jobs: a list of dicts, one per layer, e.g.
+        {"name": "zoning", "source": zoning, "database": postgres1, "table": "zoning"}
+        ("table" defaults to the database dict's table, and "name" to the table)
+    host_limits (optional): request limits per arcgis host, e.g.
+        {"www.portlandmaps.com": {"concurrency": 4, "rate": 10}, "default": {"concurrency": 8}}
+        (see etl_functions.set_host_limits)
+    sync_workers (optional): how many layers to sync at once (default 4)
+
+layers run on threads in one process, so every layer on a host shares that host's limits.
+each layer is synced with etl_functions.sync_table: a delta sync if its source has an
+edit_field, or else a full fetch that only writes the records that changed.
+    python etl_all.py
+    python etl_all.py --only zoning taxlots --summary last_run.json
+"""
+
+import sys
+import json
+import logging
+import argparse
+import etl_functions as ef
+import job_functions as jf
+import etl_params as ep
+
+
+def sync_job(job:dict):
+    """
+    returns a function that syncs one layer from etl_params.sync_jobs
+    """
+    def run():
+        return ef.sync_table(job["source"], job["database"], job.get("table"), workers=job.get("workers"))
+
+    return run
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='sync every layer in etl_params.sync_jobs')
+    parser.add_argument('--only', nargs='+', help='names of the layers to sync (defaults to all of them)')
+    parser.add_argument('--workers', type=int, default=getattr(ep, 'sync_workers', 4), help='layers synced at once')
+    parser.add_argument('--summary', help='file to save the run summary to, as json')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(threadName)s %(name)s: %(message)s')
+
+    ef.set_host_limits(getattr(ep, 'host_limits', {}))
+
+    jobs = {}
+
+    for job in ep.sync_jobs:
+        name = job.get("name") or job.get("table") or job["database"]["table"]
+
+        if not args.only or name in args.only:
+            jobs[name] = sync_job(job)
+
+    summary = jf.run_batch(jobs, workers=args.workers)
+
+    print(f'\nsynced {summary["succeeded"]} of {len(jobs)} layers in {summary["seconds"]}s ({summary["job_seconds"]}s of work)')
+
+    for record in summary["jobs"]:
+        result = record["result"] or {}
+
+        if record["status"] == "succeeded":
+            print(f'\t{record["name"]}: {result.get("mode")} sync in {record["seconds"]}s, {result.get("fetched")} fetched, '
+                  f'{result.get("updated")} updated, {result.get("inserted")} inserted, {result.get("unchanged")} unchanged, '
+                  f'{result.get("deleted")} deleted')
+        else:
+            print(f'\t{record["name"]}: FAILED after {record["seconds"]}s ({record["error"]})')
+
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2, default=str)
+
+    return 1 if summary["failed"] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
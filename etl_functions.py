@@ -2,100 +2,1299 @@
 created 6/2022 by Sam Gartrell
 """
 
+import io
+import os
+import gzip
+import json
+import time
+import random
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager, nullcontext
 import requests as r
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import chain
+from threading import Lock, BoundedSemaphore
+from urllib.parse import parse_qsl, urlencode
 from datetime import datetime as dt
+import numpy as np
+import shapely
+import shapely.wkb
+import shapely.geometry
 import geopandas as gpd
 import pandas as pd
 import sqlalchemy as sa
-import psycopg2 as ps
+from psycopg2 import sql
 from psycopg2.extras import RealDictCursor
+import metrics_functions as mf
+from cache_functions import DiskCache
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def ags_to_gdf(endpoint:dict, lyr_def:str=None, returngeo:str=None) -> gpd.GeoDataFrame:
+
+log = logging.getLogger(__name__)
+
+# requests sessions shared across calls, one per arcgis host (see mk_session)
+_sessions = {}
+_sessions_lock = Lock()
+
+# request limits per arcgis host (see set_host_limits); 'default' applies to unlisted hosts
+_host_settings = {}
+_host_limiters = {}
+_host_lock = Lock()
+
+# on-disk caches of arcgis responses, one per directory (see response_cache)
+_response_caches = {}
+_response_caches_lock = Lock()
+
+# sqlalchemy engines shared across calls, one per database url (see mk_postgis_engine)
+_engines = {}
+_engines_lock = Lock()
+
+# bookkeeping table with one row per loaded table: its sync high-water mark (see delta_sync)
+# and a version number that every write bumps (see table_version)
+STATE_TABLE_EXP = sql.SQL("""
+    CREATE TABLE IF NOT EXISTS {schema}.etl_state (
+        table_name text PRIMARY KEY,
+        high_water double precision,
+        version bigint NOT NULL DEFAULT 0,
+        updated_at timestamptz NOT NULL DEFAULT now()
+    );
+    ALTER TABLE {schema}.etl_state ADD COLUMN IF NOT EXISTS version bigint NOT NULL DEFAULT 0;
+""")
+
+BUMP_VERSION_EXP = sql.SQL("""
+    INSERT INTO {schema}.etl_state (table_name, version, updated_at) VALUES (%s, 1, now())
+    ON CONFLICT (table_name) DO UPDATE SET version = etl_state.version + 1, updated_at = now();
+""")
+
+# schemas whose etl_state table has been created by this process
+_state_schemas = set()
+
+# (schema, table) pairs this process has seen to have a HASH_COLUMN (see ensure_row_hash)
+_hashed_tables = set()
+
+# simplification tolerances of the geometry levels stored next to the full geometry (see
+# ensure_resolutions), in the units of the table's srid (degrees for wgs84: 0.0001 is ~11m)
+RESOLUTIONS = {"medium": 0.0001, "low": 0.001}
+
+# column holding each row's content hash (see row_hashes), compared to skip rewriting unchanged rows
+HASH_COLUMN = 'row_hash'
+
+# postgres column types that copy_gdf writes as whole numbers
+INTEGER_TYPES = {'smallint', 'integer', 'bigint'}
+
+# http statuses (and arcgis error codes) worth retrying: rate limiting and server trouble
+TRANSIENT_CODES = {429, 500, 502, 503, 504}
+
+
+def mk_session(endpoint:dict) -> r.Session:
+    """
+    returns the requests session shared by every fetch against the endpoint's host,
+    creating it on first use. pages reuse its pooled keep-alive connections instead
+    of opening a new connection per request. the pool is sized to endpoint["workers"].
+
+    dependencies: requests as r
+    """
+    host = endpoint["host"]
+
+    with _sessions_lock:
+        if host not in _sessions:
+            pool_size = max(endpoint.get("workers") or 1, 10)
+            session = r.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[host] = session
+
+        return _sessions[host]
+
+class HostLimiter:
+    """
+    caps the requests made to one host: at most concurrency at a time, and (if rate is set)
+    no more than rate requests per second, spaced evenly. use as a context manager around
+    each request.
+    """
+
+    def __init__(self, concurrency:int=None, rate:float=None):
+        self.interval = 1 / rate if rate else 0
+
+        self._slots = BoundedSemaphore(concurrency) if concurrency else None
+        self._next = 0  # monotonic time the next request may start
+        self._lock = Lock()
+
+    def __enter__(self):
+        start = time.monotonic()
+
+        if self._slots is not None:
+            self._slots.acquire()
+
+        if self.interval:
+            with self._lock:
+                now = time.monotonic()
+                wait = max(self._next - now, 0)
+                self._next = max(self._next, now) + self.interval
+
+            time.sleep(wait)
+
+        return time.monotonic() - start
+
+    def __exit__(self, *exc):
+        if self._slots is not None:
+            self._slots.release()
+
+def set_host_limits(limits:dict) -> None:
+    """
+    sets the request limits applied to arcgis hosts by every fetch function in this process,
+    as {host: {"concurrency": n, "rate": requests per second}}. a 'default' entry applies to
+    hosts that aren't listed. replaces any limits set before.
+    """
+    with _host_lock:
+        _host_settings.clear()
+        _host_settings.update(limits)
+        _host_limiters.clear()
+
+def host_limiter(host:str) -> HostLimiter:
+    """
+    returns the limiter shared by every request to a host (see set_host_limits), or None if
+    the host isn't limited
+    """
+    with _host_lock:
+        if host not in _host_limiters:
+            settings = _host_settings.get(host, _host_settings.get('default'))
+            _host_limiters[host] = HostLimiter(**settings) if settings else None
+
+        return _host_limiters[host]
+
+def query_url(endpoint:dict) -> str:
+    """
+    returns the query url of an arcgis rest endpoint (without a query string).
+    endpoint["scheme"] defaults to https.
+    """
+    return f'{endpoint.get("scheme", "https")}://{endpoint["host"]}/arcgis/rest/services/{endpoint["service"]}/{endpoint["service_type"]}/{endpoint["layer_id"]}/query'
+
+def query_params(endpoint:dict, lyr_def:str=None, returngeo:str=None) -> dict:
+    """
+    returns the query parameters used by the fetch functions as a dict.
+    lyr_def is a url-encoded query string (e.g. 'where=ZONE_CLASS%3D%27R%27'); when it
+    doesn't set a where clause, every record is requested (where 1=1).
+
+    dependencies: urllib.parse.parse_qsl
+    """
+    params = {'where': '1=1', 'outFields': '*'}
+
+    if lyr_def:
+        params.update(parse_qsl(lyr_def))
+
+    params['f'] = endpoint["format"]
+    params.update(generalize_params(endpoint))
+
+    if returngeo:
+        params['returnGeometry'] = returngeo
+
+    return params
+
+def generalize_params(endpoint:dict) -> dict:
+    """
+    returns the query parameters that ask the server to generalize geometry before sending
+    it, if the endpoint sets them: endpoint["max_allowable_offset"] (maxAllowableOffset, in
+    the units of the output spatial reference, i.e. degrees for geojson) and
+    endpoint["quantization"] (quantizationParameters, as a dict or json string).
+    """
+    params = {}
+
+    if endpoint.get("max_allowable_offset"):
+        params['maxAllowableOffset'] = endpoint["max_allowable_offset"]
+
+    if endpoint.get("quantization"):
+        quantization = endpoint["quantization"]
+        params['quantizationParameters'] = quantization if isinstance(quantization, str) else json.dumps(quantization)
+
+    return params
+
+def response_cache(endpoint:dict) -> DiskCache:
+    """
+    returns the on-disk cache of raw responses shared by every query against endpoints with
+    the same endpoint["response_cache"] directory (creating it on first use), or None if the
+    endpoint doesn't set one. endpoint["cache_max_bytes"] caps its size (default 2GB).
+    """
+    directory = endpoint.get("response_cache")
+
+    if not directory:
+        return None
+
+    with _response_caches_lock:
+        if directory not in _response_caches:
+            _response_caches[directory] = DiskCache(directory, endpoint.get("cache_max_bytes", 2 * 2**30))
+
+        return _response_caches[directory]
+
+def cached_response(body:bytes, url:str, headers:dict=None) -> r.Response:
+    """
+    returns a cached response body as a requests response, so callers can treat it like
+    one that came from the server
+    """
+    d = r.Response()
+    d.status_code = 200
+    d._content = body
+    d.url = url
+    d.headers.update(headers or {})
+
+    return d
+
+def ags_request(endpoint:dict, params:dict=None, method:str='get', url:str=None, headers:dict=None) -> r.Response:
+    """
+    sends a query to an arcgis rest endpoint (url defaults to its query url) with the
+    shared session, as a form-encoded POST if method='post'. the request waits for the
+    host's limits (see set_host_limits), then is timed as the 'fetch' stage and counted
+    (with any retries) per host. requests give up after endpoint["timeout"] seconds
+    without a response (default 120).
+
+    dependencies: requests as r
+    """
+    session = mk_session(endpoint)
+    limiter = host_limiter(endpoint["host"]) or nullcontext(0)
+    timeout = endpoint.get("timeout", 120)
+
+    with limiter as waited:
+        if waited:
+            mf.inc("etl_http_wait_seconds_total", waited, host=endpoint["host"])
+
+        with mf.stage('fetch') as counts:
+            if method == 'post':
+                d = session.post(url or query_url(endpoint), data=params, headers=headers, timeout=timeout)
+            else:
+                d = session.get(url or query_url(endpoint), params=params, headers=headers, timeout=timeout)
+
+            counts["bytes"] = len(d.content)
+
+    mf.count_request(endpoint["host"], d)
+
+    return d
+
+def ags_query(endpoint:dict, params:dict=None, method:str='get', url:str=None) -> tuple:
+    """
+    sends a query with ags_request and returns (response, parsed json body), retrying
+    transient failures: connection errors, timeouts, truncated bodies, and http statuses or
+    arcgis error codes in TRANSIENT_CODES. up to endpoint["retries"] retries are made
+    (default 4), each after a random wait of up to endpoint["backoff"] seconds (default 1)
+    doubled per attempt and capped at 60 (or the server's Retry-After, if it sends one).
+    raises an exception once the retries run out, or at once for any other error.
+
+    if endpoint["response_cache"] is set (a directory, see response_cache), successful
+    responses are kept there, keyed by the normalized query, and endpoint["cache_mode"]
+    decides how they're reused:
+        'revalidate' (default): a cached response is used if it's younger than
+            endpoint["cache_ttl"] seconds (default 0); otherwise the query is sent with the
+            cached ETag/Last-Modified validators (if the server gave any), and a 304 answer
+            is served from the cache
+        'refresh': queries always go to the server, and the cache is updated
+        'replay': queries are only answered from the cache, never the server (raising an
+            exception for any that aren't cached), e.g. to re-run a transform offline
+
+    dependencies: requests as r, random, time
+    """
+    retries = endpoint.get("retries", 4)
+    attempt = 0
+
+    cache = response_cache(endpoint)
+    cached = None
+    validators = None
+
+    if cache is not None:
+        mode = endpoint.get("cache_mode", "revalidate")
+        key = cache.key(method, url or query_url(endpoint), params)
+        cached = cache.get(key) if mode != 'refresh' else None
+
+        if cached is not None:
+            body, header = cached
+            stored = header["headers"]
+
+            if mode == 'replay' or time.time() - header["stored"] < endpoint.get("cache_ttl", 0):
+                mf.inc("etl_response_cache_total", host=endpoint["host"], result='hit')
+                return cached_response(body, url or query_url(endpoint), stored), json_loads(body)
+
+            validators = {}
+
+            if stored.get('ETag'):
+                validators['If-None-Match'] = stored['ETag']
+
+            if stored.get('Last-Modified'):
+                validators['If-Modified-Since'] = stored['Last-Modified']
+
+        elif mode == 'replay':
+            raise Exception(f'Error: not in the response cache (replay mode). Failed query: {params or url}')
+
+    while True:
+        retry_after = None
+
+        try:
+            d = ags_request(endpoint, params, method, url, validators or None)
+
+            # the server says the cached copy is still current
+            if d.status_code == 304 and cached is not None:
+                mf.inc("etl_response_cache_total", host=endpoint["host"], result='revalidated')
+                cache.revalidated(key, cached[1])
+
+                return cached_response(cached[0], d.url, cached[1]["headers"]), json_loads(cached[0])
+
+            if d.status_code == 200:
+                page = json_loads(d.content)
+
+                if "error" not in page:
+                    if cache is not None:
+                        mf.inc("etl_response_cache_total", host=endpoint["host"], result='miss')
+                        cache.set(key, d.content, d.headers)
+
+                    return d, page
+
+                error, transient = page["error"], page["error"].get("code") in TRANSIENT_CODES
+            else:
+                error, transient = d.status_code, d.status_code in TRANSIENT_CODES
+                retry_after = d.headers.get('Retry-After')
+
+        except (r.ConnectionError, r.Timeout, r.exceptions.ChunkedEncodingError, ValueError) as e:
+            # ValueError: a body cut off mid-transfer doesn't parse
+            error, transient = f'{type(e).__name__}: {e}', True
+
+        if not transient or attempt >= retries:
+            raise Exception(f'Error: {error}. Failed query: {params or url}')
+
+        attempt += 1
+
+        try:
+            wait = min(float(retry_after), 60)
+        except (TypeError, ValueError):
+            wait = random.uniform(0, min(endpoint.get("backoff", 1) * 2 ** attempt, 60))
+
+        mf.inc("etl_http_retries_total", host=endpoint["host"])
+        log.warning('%s from %s, retry %s of %s in %.1fs', error, endpoint["host"], attempt, retries, wait)
+
+        time.sleep(wait)
+
+def fetch_oids(endpoint:dict, lyr_def:str=None) -> list:
+    """
+    asks an arcgis rest endpoint for the OBJECTIDs matching lyr_def (returnIdsOnly),
+    returning them as a sorted list, or None if the service doesn't return an id list.
+
+    dependencies: requests as r
+    """
+    params = query_params(endpoint, lyr_def)
+    params.update({'returnIdsOnly': 'true', 'f': 'json'})
+    del params['outFields']
+
+    d, page = ags_query(endpoint, params)
+
+    if page.get("objectIds") is None:
+        return None
+
+    return sorted(page["objectIds"])
+
+def fetch_count(endpoint:dict, lyr_def:str=None) -> int:
+    """
+    asks an arcgis rest endpoint how many records match lyr_def (returnCountOnly)
+
+    dependencies: requests as r
+    """
+    params = query_params(endpoint, lyr_def)
+    params.update({'returnCountOnly': 'true', 'f': 'json'})
+    del params['outFields']
+
+    d, page = ags_query(endpoint, params)
+
+    return page["count"]
+
+def page_params(endpoint:dict, lyr_def:str=None, returngeo:str=None) -> list:
+    """
+    splits a query into max_records-sized pages that can be fetched independently,
+    returning a list of query parameter dicts (one per page).
+
+    pages are OBJECTID ranges taken from the service's id list (ordered by OBJECTID, so a
+    range the service cuts short can be finished by offset, see fetch_page). services that
+    don't return an id list are split by record count into ordered resultOffset pages.
+    """
+    params = query_params(endpoint, lyr_def, returngeo)
+    oid_field = endpoint.get("oid_field", "OBJECTID")
+    size = endpoint["max_records"]
+    pages = []
+
+    oids = fetch_oids(endpoint, lyr_def)
+
+    if oids is not None:
+        # each page covers a contiguous slice of the sorted id list
+        for i in range(0, len(oids), size):
+            lo = oids[i]
+            hi = oids[min(i + size, len(oids)) - 1]
+
+            page = dict(params, orderByFields=oid_field)
+            page['where'] = f'({params["where"]}) AND {oid_field} >= {lo} AND {oid_field} <= {hi}'
+            pages.append(page)
+
+    else:
+        count = fetch_count(endpoint, lyr_def)
+
+        for offset in range(0, count, size):
+            page = dict(params)
+            page.update({'orderByFields': oid_field, 'resultOffset': offset, 'resultRecordCount': size})
+            pages.append(page)
+
+    return pages
+
+def json_loads(content:bytes):
+    """
+    parses a json response body, with orjson if it's installed (several times faster than
+    the standard library on large pages)
+
+    dependencies: orjson (optional), json
+    """
+    with mf.stage('decode') as counts:
+        counts["bytes"] = len(content)
+
+        if orjson is not None:
+            return orjson.loads(content)
+
+        return json.loads(content)
+
+def features_geometry(features:list, content:bytes=None):
+    """
+    returns the geometries of a list of geojson features as an array, with None for features
+    that have no geometry.
+
+    with shapely 2, the geometries are built in bulk by GEOS straight from the page's raw
+    FeatureCollection bytes (content) when given, or from each feature's geometry otherwise;
+    shapely 1 builds them one at a time.
+
+    dependencies: shapely, json
+    """
+    if hasattr(shapely, 'from_geojson'):
+        try:
+            if content is not None and all(f.get('geometry') for f in features):
+                # a FeatureCollection is read as one GeometryCollection, one part per feature
+                parts = shapely.get_parts(shapely.from_geojson(content))
+
+                if len(parts) == len(features):
+                    return parts
+
+            geoms = np.full(len(features), None, dtype=object)
+            present = [i for i, f in enumerate(features) if f.get('geometry')]
+
+            if present:
+                geoms[present] = shapely.from_geojson([json.dumps(features[i]['geometry']) for i in present])
+
+            return geoms
+
+        except (shapely.errors.ShapelyError, ValueError):
+            # e.g. GEOS older than 3.10, which can't read geojson
+            pass
+
+    return np.array([shapely.geometry.shape(f['geometry']) if f.get('geometry') else None for f in features], dtype=object)
+
+def features_to_gdf(page:dict, content:bytes=None, ts:float=None) -> gpd.GeoDataFrame:
+    """
+    turns a parsed geojson page into a gdf (geometry first, then the feature properties),
+    with ts set as its timestamp column. pass the page's raw response body as content to
+    let shapely 2 build the geometries without going through python objects.
+    replaces GeoDataFrame.from_features, which builds every row and shape in python.
+
+    dependencies: geopandas as gpd, pandas as pd, shapely
+    """
+    features = page.get('features') or []
+
+    with mf.stage('build') as counts:
+        gdf = pd.DataFrame([f.get('properties') or {} for f in features], index=pd.RangeIndex(len(features)))
+        gdf.insert(0, 'geometry', features_geometry(features, content))
+
+        if ts is not None:
+            gdf['timestamp'] = ts
+
+        counts["rows"] = len(features)
+
+        # geojson is always wgs84
+        return gpd.GeoDataFrame(gdf, geometry='geometry', crs='EPSG:4326')
+
+class PageSpool:
+    """
+    on-disk checkpoint of a paged fetch, so that a run that fails partway through can be
+    resumed by the next one instead of starting over. the response body of each completed
+    page is saved (gzipped) under directory/<hash of key>/, next to a checkpoint.json that
+    records how far paging got.
+
+    key identifies the query (e.g. its url and parameters, or its list of pages), so a
+    different query never picks up another's pages. spools older than max_age seconds are
+    discarded when any spool in the directory is opened. clear() removes the spool once its
+    pages have been used.
+    """
+
+    def __init__(self, directory:str, key, max_age:float=86400):
+        self.path = os.path.join(directory, hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest())
+        self.checkpoint = {}
+
+        os.makedirs(directory, exist_ok=True)
+
+        # forget spools left behind by runs too long ago to trust
+        for name in os.listdir(directory):
+            checkpoint = self._read_checkpoint(os.path.join(directory, name))
+
+            if checkpoint is not None and time.time() - checkpoint.get("created", 0) > max_age:
+                log.info('discarding stale page spool %s', name)
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+        self.checkpoint = self._read_checkpoint(self.path)
+
+        if self.checkpoint is None:
+            shutil.rmtree(self.path, ignore_errors=True)
+            os.makedirs(self.path)
+            self.update(created=time.time())
+
+    @staticmethod
+    def _read_checkpoint(path:str) -> dict:
+        try:
+            with open(os.path.join(path, 'checkpoint.json')) as f:
+                return json.load(f)
+
+        except (OSError, ValueError):
+            return None
+
+    def _replace(self, name:str, data:bytes) -> None:
+        # write to a temporary file first, so a crash never leaves a partial file behind
+        tmp = os.path.join(self.path, f'{name}.tmp')
+
+        with open(tmp, 'wb') as f:
+            f.write(data)
+
+        os.replace(tmp, os.path.join(self.path, name))
+
+    def update(self, **checkpoint) -> None:
+        """
+        records checkpoint values (e.g. the next offset to fetch)
+        """
+        self.checkpoint = dict(self.checkpoint or {}, **checkpoint)
+        self._replace('checkpoint.json', json.dumps(self.checkpoint).encode())
+
+    def pages(self) -> list:
+        """
+        returns the indexes of the pages saved so far
+        """
+        return sorted(int(name[5:-8]) for name in os.listdir(self.path) if name.startswith('page-') and name.endswith('.json.gz'))
+
+    def write(self, index:int, content:bytes, **checkpoint) -> None:
+        """
+        saves page index's response body, then records any checkpoint values given
+        """
+        self._replace(f'page-{index:06d}.json.gz', gzip.compress(content, compresslevel=1))
+
+        if checkpoint:
+            self.update(**checkpoint)
+
+    def load(self, index:int) -> gpd.GeoDataFrame:
+        """
+        returns saved page index as a gdf, timestamped with when it was fetched
+        """
+        path = os.path.join(self.path, f'page-{index:06d}.json.gz')
+
+        with gzip.open(path) as f:
+            content = f.read()
+
+        return features_to_gdf(json_loads(content), content, os.path.getmtime(path))
+
+    def clear(self) -> None:
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def mk_spool(endpoint:dict, key) -> PageSpool:
+    """
+    returns the PageSpool for a query against the endpoint, if endpoint["spool_dir"] is set
+    (otherwise None). endpoint["spool_max_age"] is how many seconds a spool may be resumed
+    for (default 86400).
+    """
+    if not endpoint.get("spool_dir"):
+        return None
+
+    return PageSpool(endpoint["spool_dir"], [query_url(endpoint), key], endpoint.get("spool_max_age", 86400))
+
+def fetch_page(endpoint:dict, params:dict, method:str='get', spool=None, index:int=None) -> gpd.GeoDataFrame:
+    """
+    fetches a single page of records using the shared session (retrying transient failures,
+    see ags_query) and returns it as a gdf (with a timestamp field added), raising an
+    exception if the service returns an error.
+    with method='post', the query is sent as a form-encoded body instead of a query string.
+    if a PageSpool is given, the page's response body is saved to it as page index.
+
+    a page (an OBJECTID range, id batch or resultOffset page) can hold more records than
+    the service returns per request (its maxRecordCount, which may be below
+    endpoint["max_records"]). when the service says it cut the page short
+    (exceededTransferLimit) before the page's resultRecordCount (if it has one) was reached,
+    the rest is requested by offset and joined onto the page.
+
+    dependencies: requests as r, datetime as dt
+    """
+    d, page = ags_query(endpoint, params, method)
+    content = d.content
+
+    start = int(params.get('resultOffset', 0))
+    wanted = int(params['resultRecordCount']) if params.get('resultRecordCount') else None
+    features = page.get('features') or []
+
+    def cut_short():
+        return exceeded_transfer_limit(page) and page.get('features') and (wanted is None or len(features) < wanted)
+
+    if cut_short():
+        features = list(features)
+        rest = dict(params, orderByFields=params.get('orderByFields') or endpoint.get("oid_field", "OBJECTID"))
+
+        while cut_short():
+            log.info('page cut short by the service at %s records, fetching the rest', len(features))
+
+            more = dict(rest, resultOffset=start + len(features))
+
+            if wanted is not None:
+                more['resultRecordCount'] = wanted - len(features)
+
+            d, page = ags_query(endpoint, more, method)
+            features += page.get('features') or []
+
+        page = {"type": "FeatureCollection", "features": features}
+        content = json.dumps(page).encode()
+
+    if spool is not None:
+        spool.write(index, content)
+
+    return features_to_gdf(page, content, dt.timestamp(dt.now()))
+
+def exceeded_transfer_limit(page:dict) -> bool:
+    """
+    returns True if a parsed query response says the service held back matching records
+    (exceededTransferLimit: in the properties of geojson responses, at the top of json ones)
+    """
+    return bool(page.get('exceededTransferLimit') or (page.get('properties') or {}).get('exceededTransferLimit'))
+
+def ags_pages(endpoint:dict, lyr_def:str=None, returngeo:str=None, workers:int=None):
+    """
+    pages data from an arcgis rest server endpoint in geojson format, yielding each page
+    as its own geodataframe (gdf) as soon as it's parsed. nothing is kept between pages, so
+    a layer can be processed or loaded (see pages_to_postgis) with flat memory use.
+
+    if workers (or endpoint["workers"]) is set, the pages are planned up front from the
+    service's id list (or record count) and fetched concurrently by that many threads;
+    otherwise pages are requested one after another by offset.
+    endpoint["max_pages"] caps the number of pages requested by offset (for testing).
+
+    failed requests are retried (see ags_query). if endpoint["spool_dir"] is set, completed
+    pages are also saved there (see PageSpool): when a run still fails, the next run of the
+    same query yields the saved pages again without fetching them, and only requests the
+    pages that are missing (or resumes paging from the last good offset). concurrent pages
+    are planned once per spool: a resumed run reuses the failed run's plan (kept in the
+    checkpoint), so edits to the layer in between don't throw the spooled pages away.
+
+    dependencies: requests as r, datetime as dt, geopandas as gpd
+    """
+    workers = workers or endpoint.get("workers")
+
+    if workers:
+        # keyed by the query rather than its pages, which move with the layer's id list
+        spool = mk_spool(endpoint, ['planned', query_params(endpoint, lyr_def, returngeo)])
+
+        if spool is not None and spool.checkpoint.get("plan"):
+            pages = spool.checkpoint["plan"]
+        else:
+            pages = page_params(endpoint, lyr_def, returngeo)
+
+            if spool is not None:
+                spool.update(plan=pages)
+
+        spooled = set(spool.pages()) if spool is not None else set()
+
+        if spooled:
+            log.info('resuming: %s of %s pages spooled in %s', len(spooled), len(pages), spool.path)
+
+        log.info('fetching %s pages with %s workers', len(pages) - len(spooled), workers)
+
+        # only keep a couple of pages per worker in flight, and yield them in order
+        pool = ThreadPoolExecutor(max_workers=workers)
+        pending = deque()
+
+        try:
+            for i, params in enumerate(pages):
+                if i in spooled:
+                    pending.append(pool.submit(spool.load, i))
+                else:
+                    pending.append(pool.submit(fetch_page, endpoint, params, 'get', spool, i))
+
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+        except Exception:
+            if spool is not None:
+                log.error('paging failed; %s pages are spooled in %s for the next run', len(spool.pages()), spool.path)
+            raise
+
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        if spool is not None:
+            spool.clear()
+
+        return
+
+    # offsets only mean the same thing from one request (or run) to the next in a fixed order
+    params = query_params(endpoint, lyr_def, returngeo)
+    params.setdefault('orderByFields', endpoint.get("oid_field", "OBJECTID"))
+
+    offset = 0
+    iter = 0
+    exceeded_limit = True
+    max_pages = endpoint.get("max_pages")
+    spool = mk_spool(endpoint, params)
+
+    # replay the pages a previous run got, then carry on from where it stopped
+    if spool is not None and spool.checkpoint.get("pages"):
+        log.info('resuming from offset %s: %s pages spooled in %s', spool.checkpoint["offset"], spool.checkpoint["pages"], spool.path)
+
+        for i in range(spool.checkpoint["pages"]):
+            yield spool.load(i)
+
+        offset = spool.checkpoint["offset"]
+        iter = spool.checkpoint["pages"]
+        exceeded_limit = not spool.checkpoint["done"]
+
+    # get records from url
+    while exceeded_limit and not (max_pages and iter >= max_pages):
+        try:
+            d, page = ags_query(endpoint, dict(params, resultOffset=offset))
+
+        except Exception:
+            log.error('paging failed at offset %s', offset)
+
+            if spool is not None:
+                log.error('%s pages are spooled in %s for the next run', iter, spool.path)
+
+            raise
+
+        features = page.get('features') or []
+
+        # verify that there are more records to recieve before looping
+        try:
+            exceeded_limit = page['properties']['exceededTransferLimit'] and len(features) > 0
+        except KeyError:
+            exceeded_limit = False
+
+        # increment offset and iterator after previous page is confirmed successful
+        # (by the records actually returned, which the server may cap below max_records)
+        offset += len(features)
+        iter += 1
+
+        if spool is not None:
+            spool.write(iter - 1, d.content, pages=iter, offset=offset, done=not exceeded_limit)
+
+        log.info('round %s: %s records fetched', iter, len(features))
+
+        # make the page into a timestamped gdf and hand it to the caller
+        yield features_to_gdf(page, d.content, dt.timestamp(dt.now()))
+
+    if spool is not None:
+        spool.clear()
+
+def ags_to_gdf(endpoint:dict, lyr_def:str=None, returngeo:str=None, workers:int=None) -> gpd.GeoDataFrame:
+    """
+    pages data from an arcgis rest server endpoint in geojson format,
+    turns each page into its own pandas geodataframe (gdf), then flattens them into one gdf
+
+    (see ags_pages for paging options; use it directly to avoid holding the whole layer in memory)
+
+    dependencies: geopandas as gpd, pandas as pd
+    """
+    gdf_list = list(ags_pages(endpoint, lyr_def, returngeo, workers))
+
+    if not gdf_list:
+        return gpd.GeoDataFrame()
+
+    # after pagination is complete, flatten the list of dataframes into one variable
+    compiled_gdf = pd.concat(gdf_list, axis=0)
+
+    log.info('geodataframe created successfully (%s records)', len(compiled_gdf))
+
+    # return the compiled geodataframe
+    return compiled_gdf
+
+def to_ewkb(geoseries:gpd.GeoSeries):
+    """
+    returns the geometries of a geoseries as hex-encoded ewkb (carrying the series' srid),
+    which postgis accepts as text input for geometry columns.
+
+    dependencies: shapely
+    """
+    srid = geoseries.crs.to_epsg() if geoseries.crs else None
+
+    # shapely 2 encodes the whole array at once; shapely 1 needs one call per geometry
+    if hasattr(shapely, 'to_wkb'):
+        geoms = np.asarray(geoseries.array)
+
+        if srid:
+            geoms = shapely.set_srid(geoms, srid)
+
+        return shapely.to_wkb(geoms, hex=True, include_srid=bool(srid))
+
+    return [shapely.wkb.dumps(g, hex=True, srid=srid) if g is not None else None for g in geoseries]
+
+def row_hashes(gdf:gpd.GeoDataFrame) -> np.ndarray:
+    """
+    returns a 64-bit content hash of each row of a gdf: of its attributes (leaving out the
+    fetch "timestamp" and the simplified geometry_<level> columns) and its geometry as wkb,
+    so a record fetched again without changes hashes the same as the stored copy.
+    values are hashed as text, with numbers written as floats and nulls as empty strings,
+    so a value hashes alike whatever dtype its page gave the column (e.g. int in one page,
+    float in the next because of a null, or object in a page where it's always null).
+
+    dependencies: pandas as pd, shapely, numpy as np
+    """
+    geom_col = gdf.geometry.name
+    fields = sorted(c for c in gdf.columns if c not in (geom_col, 'timestamp', HASH_COLUMN) and not str(c).startswith('geometry_'))
+
+    df = pd.DataFrame(index=pd.RangeIndex(len(gdf)))
+
+    for f in fields:
+        values = gdf[f]
+        numeric = pd.api.types.is_numeric_dtype(values) or pd.api.types.infer_dtype(values, skipna=True) in (
+            'integer', 'floating', 'mixed-integer-float', 'boolean', 'empty'
+        )
+
+        text = values.astype('float64').astype(str) if numeric else values.astype(str)
+        df[f] = text.where(values.notna(), '').to_numpy(dtype=object)
+
+    if hasattr(shapely, 'to_wkb'):
+        df[geom_col] = shapely.to_wkb(np.asarray(gdf.geometry.array))
+    else:
+        df[geom_col] = [shapely.wkb.dumps(g) if g is not None else None for g in gdf.geometry]
+
+    return pd.util.hash_pandas_object(df, index=False).to_numpy().view(np.int64)
+
+def with_row_hash(gdf:gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    returns a copy of a gdf with its row_hashes in the HASH_COLUMN column
+    """
+    gdf = gdf.copy()
+    gdf[HASH_COLUMN] = row_hashes(gdf)
+
+    return gdf
+
+def ensure_row_hash(database:dict, table:str) -> None:
+    """
+    adds the HASH_COLUMN column to a table loaded before rows were hashed. its rows start
+    out without a hash, so the next refresh rewrites (and hashes) them all once.
+
+    the catalog is checked first (once per table per process), since ALTER TABLE waits for
+    an exclusive lock even when the column exists, stalling behind (and then blocking)
+    readers such as streamed responses.
+
+    dependencies: psycopg2
+    """
+    key = (database["schema"], table)
+
+    if key in _hashed_tables:
+        return
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(
+            'SELECT 1 FROM information_schema.columns WHERE table_schema = %s AND table_name = %s AND column_name = %s;',
+            [database["schema"], table, HASH_COLUMN]
+        )
+
+        if cur.fetchone() is None:
+            cur.execute(sql.SQL('ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS {} bigint;').format(
+                sql.Identifier(database["schema"]), sql.Identifier(table), sql.Identifier(HASH_COLUMN)
+            ))
+
+    _hashed_tables.add(key)
+
+def column_types(cur, schema:str, table:str) -> dict:
+    """
+    returns {column name: type} for an existing table (temp tables included, with schema
+    'pg_temp'), e.g. {"OBJECTID": "bigint", "ZONE_CLASS": "text", ...}
+
+    dependencies: psycopg2
+    """
+    target = sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(table))
+
+    cur.execute("""
+        SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute
+        WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped;
+    """, [target.as_string(cur)])
+
+    return dict(cur.fetchall())
+
+def copy_gdf(cur, schema:str, table:str, gdf:gpd.GeoDataFrame) -> None:
+    """
+    writes a gdf into an existing table with COPY, using the gdf's column names
+    (geometry is sent as hex ewkb). runs on the caller's cursor and doesn't commit.
+
+    the table's column types come from the first page it was created from, so each page is
+    written to match them: a page can give an integer field floats (when it holds a null)
+    or objects (when it's all nulls), which are written as whole numbers again. nulls are
+    sent as \\N, so empty strings stay empty strings.
+
+    dependencies: psycopg2, pandas as pd, io
     """
-    pages data from an arcgis rest server endpoint in geojson format,
-    turns each page into its own pandas geodataframe (gdf), then flattens them into one gdf
+    geom_col = gdf.geometry.name
+    types = column_types(cur, schema, table)
+
+    df = pd.DataFrame(gdf.drop(columns=geom_col))
+
+    for c in df.columns:
+        if types.get(c) in INTEGER_TYPES and not pd.api.types.is_integer_dtype(df[c]):
+            df[c] = pd.to_numeric(df[c]).astype('Int64')
+
+    df[geom_col] = to_ewkb(gdf.geometry)
+
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, na_rep='\\N')
+    buf.seek(0)
+
+    exp = sql.SQL("COPY {}.{} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(
+        sql.Identifier(schema),
+        sql.Identifier(table),
+        sql.SQL(', ').join(sql.Identifier(c) for c in df.columns)
+    )
+
+    with mf.stage('db_write', op='copy') as counts:
+        cur.copy_expert(exp.as_string(cur), buf)
 
-    dependencies: requests as r, datetime as dt, geopandas as gpd, pandas as pd
+        counts["rows"] = len(df)
+        counts["bytes"] = buf.tell()
+
+def pages_to_postgis(database:dict, table:str, pages, if_exists:str=None, progress:dict=None) -> int:
     """
-    offset = 0
-    iter = 0
-    exceeded_limit = True
-    gdf_list = []
+    streams gdf pages (e.g. from ags_pages) into a postgis table, writing and committing
+    each page with COPY as soon as it arrives, and returns the number of rows written.
+    if a progress dict is given, its "pages" and "rows" counts are kept up to date.
 
-    # create url
-    if lyr_def:
-        url = f'https://{endpoint["host"]}/arcgis/rest/services/{endpoint["service"]}/{endpoint["service_type"]}/{endpoint["layer_id"]}/query?{lyr_def}&outFields=*&f={endpoint["format"]}'
-    else:
-        url = f'https://{endpoint["host"]}/arcgis/rest/services/{endpoint["service"]}/{endpoint["service_type"]}/{endpoint["layer_id"]}/query?outFields=*&where=1%3D1&f={endpoint["format"]}'
-    
-    if returngeo:
-        url += f'&returnGeometry={returngeo}'
+    the table is created from the first page's columns (with geopandas' to_postgis), using
+    if_exists (defaults to database["if_exists"]) to decide what happens to an existing table.
 
-    # get records from url
-    # while exceeded_limit:  # for actual
-    for i in range(4):  # for testing
-        current_url = f'{url}&resultOffset={offset}'
-        d = r.get(
-            current_url
-            )
-        print(f'request made using: \n{current_url}')
-            
-
-        # verify HTTP status
-        if d.status_code != 200:
-            if offset > 0:
-                raise Exception(
-                    f'Unknown error. Last successful batch offset: {offset}.')
-            else:
-                raise ValueError('Incorrect url probably.')
+    with if_exists='replace', the live table isn't touched until the load is done: pages are
+    copied into a <table>_staging table, which gets its primary key, indexes and statistics
+    before it's swapped in for the live table in one transaction (see swap_table), so
+    readers keep seeing the old table until the new one is complete. if the load fails,
+    the live table is left as it was.
 
-        # initialize a dict variable for current geojson
-        page = d.json()
+    with if_exists='merge', only the rows that changed are written (see merge_pages).
+    every row is stored with its content hash (see row_hashes).
 
-        # additional HTTP error handling, just in case
-        try:
-            print(f'Error:{page["error"]}')
-            exit()
+    dependencies: psycopg2, geopandas as gpd
+    """
+    if_exists = if_exists or database["if_exists"]
 
-        except:
-            pass
+    if if_exists == 'merge':
+        return merge_pages(database, table, pages, progress)["fetched"]
 
-        # increment offset and iterator after previous page is confirmed successful
-        offset += endpoint["max_records"]
-        iter += 1
+    staged = if_exists == 'replace'
+    target = f'{table}_staging' if staged else table
+    rows = 0
+    created = False
 
-        # add timestamp and append to current geojson, one feature at a time
-        ts = dt.timestamp(dt.now())
+    ensure_state_table(database)
 
-        for feature in page['features']:
-            feature['properties']['timestamp'] = ts
+    # borrow a connection from the shared pool
+    with pg_connect(database) as con, con.cursor() as cur:
+        for page in pages:
+            page = with_row_hash(page)
 
-        # make the dict into a gdf and append it to a list (to be flattened later)
-        p_gdf = gpd.GeoDataFrame.from_features(page)
-        gdf_list.append(p_gdf)
+            # create (or replace) the table from an empty copy of the first page
+            if not created:
+                page.head(0).to_postgis(target, mk_postgis_engine(database), database['schema'], if_exists=if_exists)
+                created = True
 
-        print(f'round {iter}: {len(page["features"])} records added')
+                # simplified geometry columns are generated as rows are copied in
+                if staged:
+                    ensure_resolutions(database, target)
+                else:
+                    ensure_row_hash(database, target)
 
-        # verify that there are more records to recieve before looping
-        try:
-            exceeded_limit = d.json()['properties']['exceededTransferLimit']
-        except KeyError:
-            exceeded_limit = False
-    
-    # after pagination is complete, flatten the list of dataframes into one variable
-    compiled_gdf = pd.concat(gdf_list, axis=0)
+            copy_gdf(cur, database['schema'], target, page)
 
-    print(f'\ngeodataframe created successfully')
+            if not staged:
+                bump_version(cur, database['schema'], table)
 
-    # return the compiled geodataframe
-    return compiled_gdf
+            con.commit()
+
+            rows += len(page)
+            log.info('%s records written to %s.%s', rows, database["schema"], target)
+
+            if progress is not None:
+                progress["pages"] = progress.get("pages", 0) + 1
+                progress["rows"] = rows
+
+    if created and staged:
+        ensure_primary_key(database, target)
+        ensure_spatial_index(database, target)
+        swap_table(database, target, table)
+
+    elif created:
+        ensure_spatial_index(database, table)
+        ensure_resolutions(database, table)
+
+    return rows
+
+def merge_pages(database:dict, table:str, pages, progress:dict=None) -> dict:
+    """
+    brings a table up to date with a full set of gdf pages (e.g. every record from
+    ags_pages) by writing only what changed: pages are copied into an unlogged
+    <table>_incoming table with their content hashes (see row_hashes), then, in one
+    transaction, rows whose hash differs from the stored one are updated, new rows are
+    inserted and rows missing from the pages are deleted. unchanged rows aren't touched,
+    so they cost no WAL, index updates or dead tuples. returns the counts:
+    {"fetched", "updated", "inserted", "unchanged", "deleted"}.
+
+    a progress dict, if given, is kept up to date with the "pages" and "rows" copied.
+    if the table doesn't exist yet, or the pages carry columns it doesn't have, it's
+    reloaded with pages_to_postgis(if_exists='replace') instead. if there are no pages at
+    all, nothing is changed. the table's geometry levels and spatial indexes are created if
+    it doesn't have them yet (see ensure_resolutions, ensure_spatial_index).
+
+    dependencies: psycopg2, geopandas as gpd
+    """
+    schema = database["schema"]
+    incoming = f'{table}_incoming'
+    summary = {"fetched": 0, "updated": 0, "inserted": 0, "unchanged": 0, "deleted": 0}
+
+    pages = iter(pages)
+    first = next(pages, None)
+
+    if first is None:
+        log.info('no records to merge into %s.%s', schema, table)
+        return summary
+
+    pages = chain([first], pages)
+    fields = list(with_row_hash(first).columns)
+
+    # (table_fields leaves out geometry columns)
+    existing = table_fields(database, table)
+    missing = [f for f in fields if f not in existing and f not in (first.geometry.name, HASH_COLUMN)]
+
+    if not existing or missing:
+        log.info('reloading %s.%s (%s)', schema, table, f'new columns: {missing}' if existing else 'new table')
+
+        rows = pages_to_postgis(database, table, pages, if_exists='replace', progress=progress)
+        summary.update(fetched=rows, inserted=rows)
+
+        return summary
+
+    ensure_row_hash(database, table)
+    ensure_state_table(database)
+
+    # tables loaded before geometry levels were stored get them now (once)
+    added = ensure_resolutions(database, table)
+
+    target = sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(table))
+    source = sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(incoming))
+    cols = sql.SQL(', ').join(sql.Identifier(f) for f in fields)
+
+    # unchanged rows are the ones neither updated nor inserted
+    merge_exp = sql.SQL("""
+        WITH updated AS (
+            UPDATE {target} AS t SET {set_clause}
+            FROM {source} AS s
+            WHERE t."OBJECTID" = s."OBJECTID" AND t.{hash} IS DISTINCT FROM s.{hash}
+            RETURNING 1
+        ), inserted AS (
+            INSERT INTO {target} ({cols})
+            SELECT {cols} FROM {source} AS s
+            WHERE NOT EXISTS (SELECT 1 FROM {target} AS t WHERE t."OBJECTID" = s."OBJECTID")
+            RETURNING 1
+        ), deleted AS (
+            DELETE FROM {target} AS t
+            WHERE NOT EXISTS (SELECT 1 FROM {source} AS s WHERE s."OBJECTID" = t."OBJECTID")
+            RETURNING 1
+        )
+        SELECT (SELECT count(*) FROM updated), (SELECT count(*) FROM inserted), (SELECT count(*) FROM deleted);
+    """).format(
+        target=target,
+        source=source,
+        cols=cols,
+        hash=sql.Identifier(HASH_COLUMN),
+        set_clause=sql.SQL(', ').join(
+            sql.SQL('{0} = s.{0}').format(sql.Identifier(f)) for f in fields if f != "OBJECTID"
+        )
+    )
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(sql.SQL('DROP TABLE IF EXISTS {0}; CREATE UNLOGGED TABLE {0} (LIKE {1});').format(source, target))
+
+    try:
+        with pg_connect(database) as con, con.cursor() as cur:
+            for page in pages:
+                copy_gdf(cur, schema, incoming, with_row_hash(page))
+                con.commit()
+
+                summary["fetched"] += len(page)
+                log.info('%s records copied to %s.%s', summary["fetched"], schema, incoming)
+
+                if progress is not None:
+                    progress["pages"] = progress.get("pages", 0) + 1
+                    progress["rows"] = summary["fetched"]
+
+            cur.execute(sql.SQL('ANALYZE {};').format(source))
+
+            with mf.stage('db_write', op='merge') as counts:
+                cur.execute(merge_exp)
+                updated, inserted, deleted = cur.fetchone()
+
+                counts["rows"] = updated + inserted + deleted
+
+            if updated or inserted or deleted or added:
+                bump_version(cur, schema, table)
+
+    finally:
+        with pg_connect(database) as con, con.cursor() as cur:
+            cur.execute(sql.SQL('DROP TABLE IF EXISTS {};').format(source))
+
+    ensure_spatial_index(database, table)
+
+    summary.update(updated=updated, inserted=inserted, deleted=deleted, unchanged=summary["fetched"] - updated - inserted)
+    log.info('merged into %s.%s: %s', schema, table, summary)
+
+    return summary
+
+def ensure_primary_key(database:dict, table:str) -> None:
+    """
+    makes "OBJECTID" a table's primary key, unless it already has one. fails (leaving the
+    table as it was) if the table holds duplicate or null OBJECTIDs.
+
+    dependencies: psycopg2
+    """
+    target = sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(table))
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute("SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p';", [target.as_string(cur)])
+
+        if cur.fetchone() is None:
+            cur.execute(sql.SQL('ALTER TABLE {} ADD PRIMARY KEY ("OBJECTID");').format(target))
+
+def swap_table(database:dict, staging:str, table:str) -> None:
+    """
+    replaces a table with a fully built staging table in one transaction: the old table is
+    dropped, the staging table is renamed in its place, and the staging table's indexes
+    (primary key included) are renamed to match, then the table's version is bumped.
+
+    queries that arrive during the swap wait for it and then read the new table. the swap
+    waits at most database["swap_lock_timeout"] (default '60s') for running queries on the
+    old table to finish, and fails (changing nothing) if they don't.
+
+    dependencies: psycopg2
+    """
+    schema = database["schema"]
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute('SET LOCAL lock_timeout = %s;', [database.get("swap_lock_timeout", "60s")])
+
+        cur.execute('SELECT indexname FROM pg_indexes WHERE schemaname = %s AND tablename = %s;', [schema, staging])
+        indexes = [row[0] for row in cur.fetchall()]
+
+        cur.execute(sql.SQL('DROP TABLE IF EXISTS {}.{};').format(sql.Identifier(schema), sql.Identifier(table)))
+        cur.execute(sql.SQL('ALTER TABLE {}.{} RENAME TO {};').format(sql.Identifier(schema), sql.Identifier(staging), sql.Identifier(table)))
+
+        # e.g. idx_<table>_staging_geometry -> idx_<table>_geometry, <table>_staging_pkey -> <table>_pkey
+        for index in indexes:
+            if staging in index:
+                cur.execute(sql.SQL('ALTER INDEX {}.{} RENAME TO {};').format(
+                    sql.Identifier(schema), sql.Identifier(index), sql.Identifier(index.replace(staging, table))
+                ))
+
+        bump_version(cur, schema, table)
+
+    log.info('swapped %s.%s in for %s.%s', schema, staging, schema, table)
+
+def ensure_spatial_index(database:dict, table:str) -> None:
+    """
+    creates the GIST indexes used by spatial queries on a table's geometry column (if they
+    don't exist yet), then refreshes the table's planner statistics. besides the geometry
+    index, an index on geometry::geography backs radius searches in meters.
+
+    dependencies: psycopg2
+    """
+    target = sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(table))
+
+    # idx_<table>_geometry is the name geoalchemy gives the index it creates with the table
+    exp = sql.SQL("""
+        CREATE INDEX IF NOT EXISTS {geom_idx} ON {target} USING GIST (geometry);
+        CREATE INDEX IF NOT EXISTS {geog_idx} ON {target} USING GIST ((geometry::geography));
+        ANALYZE {target};
+    """).format(
+        target=target,
+        geom_idx=sql.Identifier(f'idx_{table}_geometry'),
+        geog_idx=sql.Identifier(f'idx_{table}_geography')
+    )
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(exp)
+
+def ensure_resolutions(database:dict, table:str) -> list:
+    """
+    stores a simplified copy of a table's geometry for each level in database["resolutions"]
+    ({level: tolerance}, defaults to RESOLUTIONS), as a generated geometry_<level> column that
+    postgres keeps in step with the geometry column on every insert and update. levels whose
+    column already exists are left alone (drop the column to change its tolerance), and the
+    table isn't altered at all if every level is stored. returns the levels added.
+    set database["resolutions"] to {} to store full geometry only.
+
+    dependencies: psycopg2
+    """
+    stored = table_fields(database, table, geometry=True)
+    levels = {level: tolerance for level, tolerance in database.get("resolutions", RESOLUTIONS).items()
+              if f'geometry_{level}' not in stored}
+
+    if not levels:
+        return []
+
+    log.info('adding %s geometry to %s.%s', ', '.join(levels), database["schema"], table)
+
+    exp = sql.SQL('ALTER TABLE {}.{} {};').format(
+        sql.Identifier(database["schema"]),
+        sql.Identifier(table),
+        sql.SQL(', ').join(
+            sql.SQL('ADD COLUMN IF NOT EXISTS {} geometry GENERATED ALWAYS AS (ST_SimplifyPreserveTopology(geometry, {})) STORED').format(
+                sql.Identifier(f'geometry_{level}'), sql.Literal(float(tolerance))
+            )
+            for level, tolerance in levels.items()
+        )
+    )
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(exp)
+
+    return list(levels)
+
+def geometry_column(database:dict, resolution:str=None) -> str:
+    """
+    returns the name of the column holding a resolution level of the geometry: 'full' (or
+    None) is the geometry column itself, other levels are those in database["resolutions"]
+    (see ensure_resolutions). raises a ValueError for unknown levels.
+    """
+    if resolution in (None, 'full'):
+        return 'geometry'
+
+    levels = database.get("resolutions", RESOLUTIONS)
+
+    if resolution not in levels:
+        raise ValueError(f"unknown resolution '{resolution}' (use one of: {', '.join(['full', *levels])})")
+
+    return f'geometry_{resolution}'
 
 def mk_postgis_engine(database:dict, mk_engine:bool=True):
     """
     recieves a database dict, returns either an sqlalchemy engine object (if mk_engine==True),
     or just a database url (if mk_engine==False).
 
+    engines are shared process-wide: every call for the same database returns the same
+    pooled engine, configured by the database dict (see engine_options).
+
     dependencies: sqlalchemy as sa
     """
     if database["port"] not in (None, '', False):
@@ -104,183 +1303,681 @@ def mk_postgis_engine(database:dict, mk_engine:bool=True):
        url = f'postgresql://{database["user"]}:{database["password"]}@{database["host"]}/{database["database"]}'
 
     if mk_engine:
-        engine = sa.create_engine(url)
-        return engine
+        with _engines_lock:
+            if url not in _engines:
+                _engines[url] = sa.create_engine(url, **engine_options(database))
+
+            return _engines[url]
     else:
         return url
 
-
-def oids_to_gdf(endpoint:dict, oid_list:list) -> gpd.GeoDataFrame:
+def engine_options(database:dict) -> dict:
     """
-    recieves an endpoint dict and a list of OBJECTIDs;
-    retrieves records with corresponsing ids and returns a geodataframe
+    returns the connection pool settings for a database dict as create_engine() keyword
+    arguments; each can be overridden by the key of the same name in the dict.
+    """
+    return {
+        "pool_size": database.get("pool_size", 5),
+        "max_overflow": database.get("max_overflow", 10),
+        "pool_pre_ping": database.get("pool_pre_ping", True),
+        "pool_recycle": database.get("pool_recycle", 1800),
+    }
+
+def register_engine(database:dict, engine) -> None:
+    """
+    makes an existing engine (e.g. the one owned by flask-sqlalchemy) the shared engine
+    for a database dict, so every helper in this module borrows from its pool.
+    """
+    with _engines_lock:
+        _engines[mk_postgis_engine(database, mk_engine=False)] = engine
 
-    Note: doesn't support paging
+@contextmanager
+def pg_connect(database:dict):
+    """
+    borrows a psycopg2 connection from the database's shared pool for the duration of a
+    with-block. the transaction is committed when the block exits (or rolled back if it
+    raises), and the connection goes back to the pool.
 
-    dependencies: requests as r, datetime as dt, geopandas as gpd
+    dependencies: sqlalchemy as sa
     """
-    # create OBJECTID query string
-    oid_def = 'objectIds='
+    con = mk_postgis_engine(database).raw_connection()
 
-    # check if the caller is trying to get all records, call the regular paging function if so
-    if oid_list == ['all']:
-        print('refreshing all records')
-        return ags_to_gdf(endpoint)
+    try:
+        yield con
+        con.commit()
+
+    except BaseException:
+        con.rollback()
+        raise
+
+    finally:
+        con.close()
 
-    # add segments to OBJECTID query string for each sought ID
-    for i in oid_list:
-        oid_def += f'{i}%2C+'
 
-    # remove trailing '%2c+' bits without .strip()
-    oid_def = oid_def[:-4]
+def oids_to_gdf(endpoint:dict, oid_list:list, workers:int=None) -> gpd.GeoDataFrame:
+    """
+    recieves an endpoint dict and a list of OBJECTIDs;
+    retrieves records with corresponsing ids and returns a geodataframe
 
-    # create url
-    url = f'https://{endpoint["host"]}/arcgis/rest/services/{endpoint["service"]}/{endpoint["service_type"]}/{endpoint["layer_id"]}/query?{oid_def}&outFields=*&f={endpoint["format"]}'
+    ids are split into batches of endpoint["max_records"], and each batch is sent as a
+    form-encoded POST query (so long id lists don't run into url length limits). batches are
+    fetched concurrently by workers threads (defaults to endpoint["workers"], or 4),
+    then merged into one gdf.
 
-    # make request to url
-    d = r.get(url)
-    print(f'request made using: \n{url}\n\n')
-        
+    dependencies: requests as r, geopandas as gpd, pandas as pd
+    """
+    # check if the caller is trying to get all records, call the regular paging function if so
+    if oid_list == ['all']:
+        log.info('refreshing all records')
+        return ags_to_gdf(endpoint, workers=workers)
 
-    # verify HTTP status
-    if d.status_code == None:
-        raise ValueError('Incorrect url probably.')
-    elif d.status_code != 200:
-        raise Exception(f'Error: {d.status_code}.')
+    size = endpoint["max_records"]
+    workers = workers or endpoint.get("workers") or 4
 
-    # initialize a dict variable for current record
-    record = d.json()
+    # the id list does the selecting, so no where clause is needed
+    # (ordered, so a batch the service cuts short can be finished by offset, see fetch_page)
+    params = dict(query_params(endpoint), orderByFields=endpoint.get("oid_field", "OBJECTID"))
+    del params['where']
 
-    # additional HTTP error handling
-    try:
-        print(f'Error:{record["error"]}')
-        exit()
+    # create one OBJECTID query per batch of ids
+    batches = []
 
-    except:
-        pass
+    for i in range(0, len(oid_list), size):
+        batch = dict(params)
+        batch['objectIds'] = ','.join(str(oid) for oid in oid_list[i:i + size])
+        batches.append(batch)
 
-    # add timestamp and append to current record, one feature at a time
-    ts = dt.timestamp(dt.now())
+    if not batches:
+        return gpd.GeoDataFrame()
 
-    for feature in record['features']:
-        feature['properties']['timestamp'] = ts
+    log.info('requesting %s OBJECTIDs in %s batches', len(oid_list), len(batches))
 
-    # make the dict into a gpd gdf
-    record_gdf = gpd.GeoDataFrame.from_features(record)
+    with ThreadPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+        gdf_list = list(pool.map(lambda p: fetch_page(endpoint, p, method='post'), batches))
 
     # return the compiled geodataframe
-    return record_gdf
+    return pd.concat(gdf_list, axis=0)
 
-def update_with_gdf(database:dict, table:str, gdf) -> None:
+def update_with_gdf(database:dict, table:str, gdf) -> dict:
     """
     recieves a database dict and a pre-processed geodataframe;
-    updates the database to reflect values of the input geodataframe.
+    updates the database to reflect values of the input geodataframe (geometry included),
+    inserting any records that aren't in the table yet. records whose content hash (see
+    row_hashes) matches the stored one are left alone. returns the updated, inserted and
+    unchanged counts.
+
+    the gdf is copied into a temporary staging table, then applied to the table with a
+    single set-based UPDATE ... FROM / INSERT statement, all in one transaction.
 
     note: geodataframe must have records matching those in the table (i.e. must be
     from the same source and processed in the same way as existing records).
 
-    package dependencies: psycopg2 as ps, geopandas as gpd
+    package dependencies: psycopg2, geopandas as gpd
     """
+    schema = database["schema"]
+    staging = f'{table}_update'
+    gdf = with_row_hash(gdf)
 
-    # initialize postgres connection
-    con = ps.connect(
-        host=database["host"],
-        database=database["database"],
-        user=database["user"],
-        password=database["password"]
+    # initialize dataframe/SQL variables
+    fields = list(gdf.columns.values)  #list of the gdf's fields
+    set_fields = [f for f in fields if f != "OBJECTID"]  # OBJECTID is the join key, everything else gets overwritten
+
+    target = sql.SQL('{}.{}').format(sql.Identifier(schema), sql.Identifier(table))
+    source = sql.SQL('pg_temp.{}').format(sql.Identifier(staging))
+    cols = sql.SQL(', ').join(sql.Identifier(f) for f in fields)
+
+    # update rows that changed, insert the new ones, and report how many of each
+    upsert_exp = sql.SQL("""
+        WITH updated AS (
+            UPDATE {target} AS t SET {set_clause}
+            FROM {source} AS s
+            WHERE t."OBJECTID" = s."OBJECTID" AND t.{hash} IS DISTINCT FROM s.{hash}
+            RETURNING t."OBJECTID"
+        ), inserted AS (
+            INSERT INTO {target} ({cols})
+            SELECT {cols} FROM {source} AS s
+            WHERE NOT EXISTS (SELECT 1 FROM {target} AS t WHERE t."OBJECTID" = s."OBJECTID")
+            RETURNING 1
+        )
+        SELECT (SELECT count(*) FROM updated), (SELECT count(*) FROM inserted);
+    """).format(
+        target=target,
+        source=source,
+        cols=cols,
+        hash=sql.Identifier(HASH_COLUMN),
+        set_clause=sql.SQL(', ').join(
+            sql.SQL('{0} = s.{0}').format(sql.Identifier(f)) for f in set_fields
+        )
     )
 
-    # create a cursor to read with
-    cur = con.cursor()
+    log.info('updating %s OBJECTIDs in table "%s"', len(gdf), table)
 
-    # initialize dataframe/SQL variables
-    oids = list(gdf["OBJECTID"])  #list of the gdf's OBJECTIDs
-    fields = list(gdf.columns.values)  #list of the gdf's fields
-    update_exp = [] # empty list of expressions to run later
+    ensure_state_table(database)
+    ensure_row_hash(database, table)
 
+    # borrow a connection from the shared pool (commits when the block exits)
+    with pg_connect(database) as con, con.cursor() as cur:
+        # stage the gdf in a temp table shaped like the target, dropped when the transaction ends
+        cur.execute(sql.SQL('CREATE TEMP TABLE {} (LIKE {}) ON COMMIT DROP;').format(sql.Identifier(staging), target))
+        copy_gdf(cur, 'pg_temp', staging, gdf)
 
-    # iterate through rows by oid, composing an SQL statement for each row and appending it to a list
-    for id in oids:
-        set_clause = 'SET' # start a "SET" clause for the statement
+        with mf.stage('db_write', op='upsert') as counts:
+            cur.execute(upsert_exp)
+            updated, inserted = cur.fetchone()
 
-        for field in fields:
-            if field in ("OBJECTID", 'geometry'): # ignore these fields bc they aren't expected to change
-                pass
+            counts["rows"] = updated + inserted
 
-            else:
-                val = list(gdf.query(f'OBJECTID == {id}')[field])[0] # get values at intersection of oid (row) and field (column)
-                set_clause += f""" "{field}" = '{val}',""" # add SQL language to map the field and value
+        if updated or inserted:
+            bump_version(cur, schema, table)
+
+    unchanged = len(gdf) - updated - inserted
+    log.info('finished updating: %s updated, %s inserted, %s unchanged', updated, inserted, unchanged)
 
-        set_clause = set_clause[:-1] # remove the trailing comma
+    return {"updated": updated, "inserted": inserted, "unchanged": unchanged}
 
-        # after iterating through the row's fields, assemble the final SQL expression and add it to a list
-        update_exp.append(f"""UPDATE {table} {set_clause} WHERE "OBJECTID" = {id};""")
+def retrieve_from_postgis(database:dict, table:str, oid_list:list, fields:list=None, geometry:bool=False,
+                         resolution:str=None) -> list:
+    """
+    returns a list of records (dicts, in OBJECTID order) retrieved from an input postgres
+    database/table, corresponding to the input list of objectids (or a list containing a
+    single string "all"). the ids are sent as one array parameter.
 
-    print(f'\nupdating OBJECTIDs {oids} in table "{table}"\n')
+    only fields are read (defaults to every non-geometry column). with geometry=True, each
+    record also carries its geometry as a geojson dict, at the given resolution level (see
+    geometry_column); otherwise no geometry is read at all.
 
-    for exp in update_exp:
-        print(f'executing:\n{exp}')
-        cur.execute(exp)
-        
+    dependencies: psycopg2
+    """
+    columns = [sql.Identifier(f) for f in fields or table_fields(database, table)]
+
+    if geometry:
+        columns.append(sql.SQL('ST_AsGeoJSON({})::json AS geometry').format(sql.Identifier(geometry_column(database, resolution))))
+
+    everything = oid_list in (["all"], 'all')
+
+    exp = sql.SQL('SELECT {} FROM {}.{} WHERE {} ORDER BY "OBJECTID";').format(
+        sql.SQL(', ').join(columns),
+        sql.Identifier(database["schema"]),
+        sql.Identifier(table),
+        sql.SQL('true') if everything else sql.SQL('"OBJECTID" = ANY(%s)')
+    )
+
+    log.debug('retrieving %s OBJECTIDs from %s', 'all' if everything else len(oid_list), table)
+
+    # borrow a connection from the shared pool, and create a cursor to read with
+    # (realdict cursor returns rows as dictionaries)
+    with pg_connect(database) as con, con.cursor(cursor_factory=RealDictCursor) as cur:
+        with mf.stage('db_read', op='retrieve') as counts:
+            cur.execute(exp, [] if everything else [list(oid_list)])
+
+            # get query results as a list of rows
+            res = cur.fetchall()
+
+            counts["rows"] = len(res)
+
+    return res
+
+def json_records(database:dict, table:str, fields:list, after:int=None, limit:int=None, oid_list:list=None,
+                 resolution:str=None, geometry:bool=False, itersize:int=2000):
+    """
+    yields records from an input postgres table in OBJECTID order as json text (one object
+    per record, built by postgres with row_to_json), so they can be sent on without being
+    decoded. after/limit give keyset pagination (only records with OBJECTID > after are
+    read, and at most limit of them), and oid_list restricts the records to those OBJECTIDs.
+
+    with geometry=True, each record also carries its geometry as a geojson object (built
+    with ST_AsGeoJSON, at the given resolution level, see geometry_column).
+
+    without a limit, rows are read through a server-side cursor, itersize rows at a time.
+
+    dependencies: psycopg2
+    """
+    columns = [sql.Identifier(f) for f in fields]
+
+    if geometry:
+        columns.append(sql.SQL('ST_AsGeoJSON({})::json AS geometry').format(sql.Identifier(geometry_column(database, resolution))))
+
+    conditions = []
+    params = []
+
+    if after is not None:
+        conditions.append(sql.SQL('"OBJECTID" > %s'))
+        params.append(after)
+
+    if oid_list is not None:
+        conditions.append(sql.SQL('"OBJECTID" = ANY(%s)'))
+        params.append(list(oid_list))
+
+    exp = sql.SQL('SELECT row_to_json(r)::text FROM (SELECT {} FROM {}.{} WHERE {} ORDER BY "OBJECTID"').format(
+        sql.SQL(', ').join(columns),
+        sql.Identifier(database["schema"]),
+        sql.Identifier(table),
+        sql.SQL(' AND ').join(conditions) if conditions else sql.SQL('true')
+    )
+
+    if limit is not None:
+        exp += sql.SQL(' LIMIT %s')
+        params.append(limit)
+
+    exp += sql.SQL(') AS r')
+
+    cursor_name = 'json_records' if limit is None and oid_list is None else None
+
+    with pg_connect(database) as con, con.cursor(name=cursor_name) as cur:
+        with mf.stage('db_read', op='json'):
+            cur.execute(exp, params)
+
+        while True:
+            with mf.stage('db_read', op='json') as counts:
+                rows = cur.fetchmany(itersize)
+                counts["rows"] = len(rows)
+
+            if not rows:
+                break
+
+            for row in rows:
+                yield row[0]
+
+def ensure_state_table(database:dict) -> None:
+    """
+    creates the etl_state bookkeeping table in the database's schema, unless this process
+    has already done so.
+
+    the catalog is checked first, so once the table is in place no DDL is sent: ALTER TABLE
+    waits for an exclusive lock (and needs ownership) even when there's nothing to change,
+    which would stall (or fail, for a read-only role) the api's version lookups.
+
+    dependencies: psycopg2
+    """
+    schema = database["schema"]
+
+    if schema not in _state_schemas:
+        with pg_connect(database) as con, con.cursor() as cur:
+            cur.execute(
+                "SELECT 1 FROM information_schema.columns WHERE table_schema = %s AND table_name = 'etl_state' AND column_name = 'version';",
+                [schema]
+            )
+
+            if cur.fetchone() is None:
+                cur.execute(STATE_TABLE_EXP.format(schema=sql.Identifier(schema)))
+
+        _state_schemas.add(schema)
+
+def bump_version(cur, schema:str, table:str) -> None:
+    """
+    increments a table's version number in etl_state. writers call this inside their own
+    transaction (after ensure_state_table), so the new version is visible exactly when the
+    new data is.
+    """
+    cur.execute(BUMP_VERSION_EXP.format(schema=sql.Identifier(schema)), [table])
+
+def table_version(database:dict, table:str) -> int:
+    """
+    returns a table's version number, which changes whenever one of the writers in this
+    module (in any process) changes the table. used to key cached responses.
+
+    dependencies: psycopg2
+    """
+    schema = database["schema"]
+
+    ensure_state_table(database)
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(
+            sql.SQL('SELECT version FROM {}.etl_state WHERE table_name = %s;').format(sql.Identifier(schema)),
+            [table]
+        )
+        row = cur.fetchone()
+
+    return row[0] if row else 0
+
+def get_high_water(database:dict, table:str) -> float:
+    """
+    returns the high-water mark (epoch seconds) of the last sync into a table: the value
+    saved in the etl_state table by delta_sync, or else the newest "timestamp" in the table
+    itself. returns None if the table hasn't been loaded yet.
+
+    dependencies: psycopg2
+    """
+    schema = database["schema"]
+
+    ensure_state_table(database)
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(
+            sql.SQL('SELECT high_water FROM {}.etl_state WHERE table_name = %s;').format(sql.Identifier(schema)),
+            [table]
+        )
+        row = cur.fetchone()
+
+        if row and row[0] is not None:
+            return row[0]
+
+        # fall back to the fetch timestamps written alongside each record
+        cur.execute('SELECT to_regclass(%s);', [f'"{schema}"."{table}"'])
+
+        if cur.fetchone()[0] is None:
+            return None
+
+        cur.execute(sql.SQL('SELECT max("timestamp") FROM {}.{};').format(sql.Identifier(schema), sql.Identifier(table)))
+
+        return cur.fetchone()[0]
+
+def set_high_water(database:dict, table:str, high_water:float) -> None:
+    """
+    saves the high-water mark (epoch seconds) for a table in the etl_state table
+
+    dependencies: psycopg2
+    """
+    schema = sql.Identifier(database["schema"])
+
+    ensure_state_table(database)
 
-    print('\n\nfinished updating.')
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(
+            sql.SQL("""
+                INSERT INTO {}.etl_state (table_name, high_water, updated_at) VALUES (%s, %s, now())
+                ON CONFLICT (table_name) DO UPDATE SET high_water = EXCLUDED.high_water, updated_at = EXCLUDED.updated_at;
+            """).format(schema),
+            [table, high_water]
+        )
 
-    con.commit()
-    cur.close()
-    con.close()
+def edited_since(edit_field:str, high_water:float) -> str:
+    """
+    returns a lyr_def (url-encoded where clause) selecting features whose edit-date field
+    is later than the high-water mark (epoch seconds, compared in UTC).
 
-def retrieve_from_postgis(database:dict, table:str, oid_list:list ) -> dict:
+    dependencies: datetime as dt, urllib.parse.urlencode
     """
-    returns a dictionary of records retrieved from an input postgres database/table,
-    corresponding to the input list of objectids (or a list containing a single string "all").
+    since = dt.utcfromtimestamp(high_water).strftime('%Y-%m-%d %H:%M:%S')
+
+    return urlencode({'where': f"{edit_field} > TIMESTAMP '{since}'"})
 
-    dependencies: psycopg2, ps
+def delete_missing(database:dict, table:str, oid_list:list) -> int:
     """
-    # initialize a string to represent the in IN expression's array
-    exp_array = ''
-        
-    # initialize a list to return records with
-    out_array = []
+    deletes records whose OBJECTID isn't in oid_list (e.g. the source's current id list)
+    and returns the number of records deleted.
 
-    # initialize postgres connection
-    con = ps.connect(
-        host=database["host"],
-        database=database["database"],
-        user=database["user"],
-        password=database["password"]
+    dependencies: psycopg2
+    """
+    exp = sql.SQL('DELETE FROM {}.{} WHERE NOT ("OBJECTID" = ANY(%s));').format(
+        sql.Identifier(database["schema"]),
+        sql.Identifier(table)
     )
 
-    # create a cursor to read with (realdict cursor returns rows as dictionaries)
-    cur = con.cursor(cursor_factory=RealDictCursor)
+    ensure_state_table(database)
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        with mf.stage('db_write', op='delete') as counts:
+            cur.execute(exp, [list(oid_list)])
+            deleted = counts["rows"] = cur.rowcount
+
+        if deleted:
+            bump_version(cur, database["schema"], table)
+
+    return deleted
+
+def delta_sync(endpoint:dict, database:dict, table:str, reconcile_deletes:bool=False, workers:int=None, progress:dict=None) -> dict:
+    """
+    incrementally syncs a table with its arcgis source: only features edited since the last
+    sync (per endpoint["edit_field"], the layer's last-edit-date field) are fetched and
+    upserted with update_with_gdf. with reconcile_deletes, records no longer in the source's
+    id list are deleted too. returns a summary of what was synced.
+
+    a progress dict, if given, is kept up to date with the "pages" and "rows" written.
+
+    if the table has never been loaded (or the endpoint has no edit_field), the whole layer
+    is loaded instead. edits are looked for endpoint["sync_overlap"] seconds (default 300)
+    before the saved mark, to allow for clock skew between us and the server. a table synced
+    by delta gets any geometry levels and spatial indexes it's missing.
+
+    dependencies: datetime as dt
+    """
+    started = dt.timestamp(dt.now())
+    edit_field = endpoint.get("edit_field")
+    high_water = get_high_water(database, table) if edit_field else None
+    summary = {"table": table, "fetched": 0, "updated": 0, "inserted": 0, "unchanged": 0, "deleted": 0}
+
+    if high_water is None:
+        log.info('no high-water mark for %s, loading all records', table)
+
+        summary["mode"] = "full"
+        summary["fetched"] = summary["inserted"] = pages_to_postgis(database, table, ags_pages(endpoint, workers=workers), if_exists='replace', progress=progress)
 
-    if oid_list in (["all"], 'all'):
-        exp = f'select * from {database["schema"]}.{table} order by "OBJECTID";'
     else:
-        # iteratively add ids to the array string
-        for id in oid_list:
-            exp_array += f'{str(id)}, '
+        lyr_def = edited_since(edit_field, high_water - endpoint.get("sync_overlap", 300))
+        log.info('syncing features edited since %s UTC', dt.utcfromtimestamp(high_water))
+
+        gdf = ags_to_gdf(endpoint, lyr_def, workers=workers)
+
+        summary["mode"] = "delta"
+        summary["fetched"] = len(gdf)
+
+        if len(gdf):
+            summary.update(update_with_gdf(database, table, gdf))
+
+        if progress is not None:
+            progress["rows"] = len(gdf)
+
+        if reconcile_deletes:
+            oids = fetch_oids(endpoint)
+
+            if oids is not None:
+                summary["deleted"] = delete_missing(database, table, oids)
+
+        # tables loaded before geometry levels and spatial indexes were stored get them now (once)
+        if ensure_resolutions(database, table):
+            with pg_connect(database) as con, con.cursor() as cur:
+                bump_version(cur, database["schema"], table)
+
+        ensure_spatial_index(database, table)
+
+    set_high_water(database, table, started)
+
+    log.info('sync complete: %s', summary)
+
+    return summary
+
+def sync_table(endpoint:dict, database:dict, table:str=None, workers:int=None, progress:dict=None) -> dict:
+    """
+    brings a table (defaults to database["table"]) up to date with its arcgis source: a
+    delta_sync (deletes included) if the source has an edit_field, or else a full fetch
+    that only writes the records that changed (see merge_pages). returns a summary in
+    delta_sync's format.
+    """
+    table = table or database["table"]
+
+    if endpoint.get("edit_field"):
+        return delta_sync(endpoint, database, table, reconcile_deletes=True, workers=workers, progress=progress)
+
+    summary = merge_pages(database, table, ags_pages(endpoint, workers=workers), progress=progress)
+
+    return {"table": table, "mode": "full", **summary}
+
+def spatial_query(database:dict, table:str, fields:list, bbox:list=None, point:list=None, radius:float=None,
+                  intersects:str=None, nearest:list=None, k:int=10, limit:int=1000, resolution:str=None) -> str:
+    """
+    returns the records of a table matching a spatial query as a geojson FeatureCollection
+    (built by postgis, returned as text). the filters can be combined:
+        bbox: [xmin, ymin, xmax, ymax], records intersecting the box
+        point + radius: [x, y] and a distance in meters, records within radius of the point
+        intersects: a geojson geometry (text), records intersecting it
+        nearest: [x, y], the k records closest to the point (ordered by distance)
+    coordinates are wgs84 longitude/latitude. at most limit records are returned.
+    resolution picks the level of geometry returned (see geometry_column); filtering always
+    uses the full geometry.
+
+    every filter is answered from the GIST indexes made by ensure_spatial_index.
+
+    dependencies: psycopg2
+    """
+    # inputs are built in the table's srid, looked up once per query
+    srid = sql.SQL("Find_SRID(%s, %s, 'geometry')")
+    srid_params = [database["schema"], table]
+
+    conditions = []
+    params = []
+    order = sql.SQL('t."OBJECTID"')
+    order_params = []
+
+    if bbox:
+        conditions.append(sql.SQL('ST_Intersects(t.geometry, ST_MakeEnvelope(%s, %s, %s, %s, {}))').format(srid))
+        params += list(bbox) + srid_params
+
+    if point and radius is not None:
+        conditions.append(sql.SQL('ST_DWithin(t.geometry::geography, ST_SetSRID(ST_MakePoint(%s, %s), 4326)::geography, %s)'))
+        params += list(point) + [radius]
+
+    if intersects:
+        conditions.append(sql.SQL('ST_Intersects(t.geometry, ST_SetSRID(ST_GeomFromGeoJSON(%s), {}))').format(srid))
+        params += [intersects] + srid_params
+
+    if nearest:
+        order = sql.SQL('t.geometry <-> ST_SetSRID(ST_MakePoint(%s, %s), {})').format(srid)
+        order_params = list(nearest) + srid_params
+        limit = min(k, limit)
+
+    exp = sql.SQL("""
+        SELECT json_build_object(
+            'type', 'FeatureCollection',
+            'features', coalesce(json_agg(f.feature), '[]'::json)
+        )::text
+        FROM (
+            SELECT json_build_object(
+                'type', 'Feature',
+                'id', t."OBJECTID",
+                'geometry', ST_AsGeoJSON(t.{geometry})::json,
+                'properties', json_build_object({properties})
+            ) AS feature
+            FROM {target} AS t
+            WHERE {conditions}
+            ORDER BY {order}
+            LIMIT %s
+        ) AS f;
+    """).format(
+        properties=sql.SQL(', ').join(
+            sql.SQL('{}, t.{}').format(sql.Literal(f), sql.Identifier(f)) for f in fields
+        ),
+        geometry=sql.Identifier(geometry_column(database, resolution)),
+        target=sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(table)),
+        conditions=sql.SQL(' AND ').join(conditions) if conditions else sql.SQL('true'),
+        order=order
+    )
+
+    with pg_connect(database) as con, con.cursor() as cur, mf.stage('db_read', op='query') as counts:
+        cur.execute(exp, params + order_params + [limit])
+        collection = cur.fetchone()[0]
+
+        counts["bytes"] = len(collection)
+
+    return collection
+
+def mvt_tile(database:dict, table:str, z:int, x:int, y:int, fields:list, layer:str=None, extent:int=4096, buffer:int=64,
+             resolution:str=None) -> bytes:
+    """
+    returns the records of a table that fall in web mercator tile z/x/y as a mapbox vector
+    tile (built by postgis with ST_AsMVT), carrying the given fields as attributes.
+    the layer is named after the table unless a layer name is given. resolution picks the
+    level of geometry drawn (see geometry_column).
+
+    dependencies: psycopg2
+    """
+    exp = sql.SQL("""
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(%s, %s, %s) AS geom
+        ), mvtgeom AS (
+            SELECT ST_AsMVTGeom(ST_Transform(t.{geometry}, 3857), bounds.geom, %s, %s, true) AS geom, {fields}
+            FROM {target} AS t, bounds
+            WHERE t.geometry && ST_Transform(bounds.geom, Find_SRID(%s, %s, 'geometry'))
+        )
+        SELECT ST_AsMVT(mvtgeom.*, %s, %s, 'geom') FROM mvtgeom;
+    """).format(
+        geometry=sql.Identifier(geometry_column(database, resolution)),
+        fields=sql.SQL(', ').join(sql.SQL('t.{}').format(sql.Identifier(f)) for f in fields),
+        target=sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(table))
+    )
+
+    params = [z, x, y, extent, buffer, database["schema"], table, layer or table, extent]
+
+    with pg_connect(database) as con, con.cursor() as cur, mf.stage('db_read', op='tile') as counts:
+        cur.execute(exp, params)
+        tile = cur.fetchone()[0]
+
+        counts["bytes"] = len(tile) if tile is not None else 0
+
+    return bytes(tile) if tile is not None else b''
+
+def extent_of(database:dict, table:str, oid_list:list) -> tuple:
+    """
+    returns the bounding box (xmin, ymin, xmax, ymax) of the records with the given
+    OBJECTIDs as they're currently stored, or None if none of them exist
+
+    dependencies: psycopg2
+    """
+    exp = sql.SQL("""
+        SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+        FROM (SELECT ST_Extent(geometry) AS e FROM {}.{} WHERE "OBJECTID" = ANY(%s)) AS q;
+    """).format(sql.Identifier(database["schema"]), sql.Identifier(table))
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(exp, [list(oid_list)])
+        box = cur.fetchone()
+
+    return tuple(box) if box[0] is not None else None
+
+def table_fields(database:dict, table:str, geometry:bool=False) -> list:
+    """
+    returns a table's column names in table order, reflected from the database. geometry
+    columns are left out, unless geometry=True (in which case only they are returned).
+    the internal HASH_COLUMN is always left out, so it isn't served or exported.
+
+    dependencies: psycopg2
+    """
+    exp = """
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s AND (udt_name = 'geometry') = %s AND column_name <> %s
+        ORDER BY ordinal_position;
+    """
+
+    with pg_connect(database) as con, con.cursor() as cur:
+        cur.execute(exp, [database["schema"], table, geometry, HASH_COLUMN])
+
+        return [row[0] for row in cur.fetchall()]
 
-        # remove trailing ', ' from array string
-        exp_array = exp_array[:-2]
+def read_pages(database:dict, table:str, fields:list=None, chunksize:int=50000, resolution:str=None):
+    """
+    yields the records of a postgis table (in OBJECTID order) as geodataframes of up to
+    chunksize rows, read through a server-side cursor so only one chunk is in memory at once.
+    fields defaults to every non-geometry column; geometry is always included, at the given
+    resolution level (see geometry_column).
+
+    dependencies: psycopg2, geopandas as gpd, pandas as pd
+    """
+    fields = fields or table_fields(database, table)
 
-        # put together the final expression string
-        exp = f'select * from {database["schema"]}.{table} where "OBJECTID" in ({exp_array}) order by "OBJECTID";'
+    exp = sql.SQL('SELECT {fields}, ST_AsBinary({geometry}) AS geometry FROM {target} ORDER BY "OBJECTID";').format(
+        fields=sql.SQL(', ').join(sql.Identifier(f) for f in fields),
+        geometry=sql.Identifier(geometry_column(database, resolution)),
+        target=sql.SQL('{}.{}').format(sql.Identifier(database["schema"]), sql.Identifier(table))
+    )
 
-    print(f'executing:\n\t{exp}')
+    with pg_connect(database) as con:
+        with con.cursor() as cur:
+            cur.execute("SELECT Find_SRID(%s, %s, 'geometry');", [database["schema"], table])
+            srid = cur.fetchone()[0]
 
-    # execute the select expression
-    cur.execute(exp)
+        with con.cursor(name='read_pages') as cur:
+            cur.execute(exp)
 
-    # get query results as a list of rows
-    res = cur.fetchall()
+            while True:
+                with mf.stage('db_read', op='read_pages') as counts:
+                    rows = cur.fetchmany(chunksize)
+                    counts["rows"] = len(rows)
 
-    # ditch the geometry field
-    for record in res:
-        rec = dict(record)
-        del rec['geometry']
-        out_array.append(rec)
+                if not rows:
+                    break
 
-    cur.close()
-    con.close()
+                df = pd.DataFrame(rows, columns=fields + ['geometry'])
+                geoms = gpd.GeoSeries.from_wkb([bytes(g) if g is not None else None for g in df.pop('geometry')], crs=srid or None)
 
-    return out_array
\ No newline at end of file
+                yield gpd.GeoDataFrame(df, geometry=geoms)
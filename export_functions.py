@@ -0,0 +1,229 @@
+"""
+Functions used to write geopandas dataframes to columnar formats (GeoParquet, Arrow IPC
+and FlatGeobuf), either as streams of bytes for the API's export routes or as staged
+GeoParquet files on disk for the ETL.
+
+writers accept an iterable of geodataframe "pages" (e.g. from etl_functions.ags_pages or
+etl_functions.read_pages), so nothing bigger than a page is held in memory.
+"""
+
+import io
+import os
+import glob
+import json
+import logging
+import pandas as pd
+import geopandas as gpd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+log = logging.getLogger(__name__)
+
+
+def require_pyarrow() -> None:
+    """
+    raises an ImportError if pyarrow (needed for parquet and arrow output) isn't installed
+    """
+    if pa is None:
+        raise ImportError('GeoParquet and Arrow output require the pyarrow package')
+
+class ChunkSink(io.RawIOBase):
+    """
+    write-only file object that collects whatever is written to it until drained, while
+    reporting its true position to writers (parquet/arrow writers rely on tell()).
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        self.position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        """
+        returns everything written since the last drain
+        """
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def geo_metadata(gdf:gpd.GeoDataFrame) -> dict:
+    """
+    returns the GeoParquet "geo" metadata describing a gdf's (wkb-encoded) geometry column
+    """
+    return {
+        "version": "1.0.0",
+        "primary_column": gdf.geometry.name,
+        "columns": {
+            gdf.geometry.name: {
+                "encoding": "WKB",
+                "geometry_types": [],
+                "crs": gdf.crs.to_json_dict() if gdf.crs else None,
+            }
+        },
+    }
+
+def to_arrow_table(gdf:gpd.GeoDataFrame, schema=None):
+    """
+    converts a gdf to a pyarrow table with wkb geometry and GeoParquet metadata.
+    columns with no values get a string type (rather than arrow's null type) so that later
+    pages can still be written with the same schema; pass the first page's schema as schema
+    to cast later pages to it.
+
+    dependencies: pyarrow as pa
+    """
+    require_pyarrow()
+
+    geom_col = gdf.geometry.name
+    df = pd.DataFrame(gdf.drop(columns=geom_col))
+    df[geom_col] = gdf.geometry.to_wkb()
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+
+    if schema is not None:
+        return table.cast(schema)
+
+    for i, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(i, pa.field(field.name, pa.string()), table.column(i).cast(pa.string()))
+
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'geo'] = json.dumps(geo_metadata(gdf)).encode()
+
+    return table.replace_schema_metadata(metadata)
+
+def parquet_stream(pages):
+    """
+    writes gdf pages as one GeoParquet file (one row group per page), yielding the file's
+    bytes as each row group is written.
+
+    dependencies: pyarrow
+    """
+    require_pyarrow()
+
+    sink = ChunkSink()
+    writer = None
+    schema = None
+
+    for page in pages:
+        table = to_arrow_table(page, schema)
+
+        if writer is None:
+            schema = table.schema
+            writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+
+        writer.write_table(table)
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+def arrow_stream(pages):
+    """
+    writes gdf pages as an Arrow IPC stream (wkb geometry, GeoParquet metadata on the
+    schema), yielding the stream's bytes as each page is written.
+
+    dependencies: pyarrow
+    """
+    require_pyarrow()
+
+    sink = ChunkSink()
+    writer = None
+    schema = None
+
+    for page in pages:
+        table = to_arrow_table(page, schema)
+
+        if writer is None:
+            schema = table.schema
+            writer = pa.ipc.new_stream(pa.PythonFile(sink, mode='w'), schema)
+
+        writer.write_table(table)
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+def write_flatgeobuf(pages, path:str) -> int:
+    """
+    writes gdf pages to a FlatGeobuf file at path, one page at a time, and returns the
+    number of records written. the file's schema comes from the first page.
+
+    fiona is optional (only this writer needs it), and its gdal must be 3.1 or newer to have
+    the FlatGeobuf driver.
+
+    dependencies: fiona, geopandas as gpd
+    """
+    import fiona
+    from geopandas.io.file import infer_schema
+
+    collection = None
+    rows = 0
+
+    try:
+        for page in pages:
+            if collection is None:
+                collection = fiona.open(path, 'w', driver='FlatGeobuf', schema=infer_schema(page), crs=page.crs)
+
+            collection.writerecords(page.iterfeatures())
+            rows += len(page)
+
+    finally:
+        if collection is not None:
+            collection.close()
+
+    return rows
+
+def stage_pages(pages, directory:str) -> int:
+    """
+    stages gdf pages on disk as a partitioned GeoParquet dataset (one part-NNNNN.parquet
+    file per page) in directory, replacing any parts already there. returns the number of
+    records staged. see staged_pages to read them back.
+
+    dependencies: geopandas as gpd, pyarrow
+    """
+    require_pyarrow()
+
+    os.makedirs(directory, exist_ok=True)
+
+    for path in glob.glob(os.path.join(directory, 'part-*.parquet')):
+        os.remove(path)
+
+    rows = 0
+
+    for i, page in enumerate(pages):
+        page.to_parquet(os.path.join(directory, f'part-{i:05d}.parquet'), index=False)
+        rows += len(page)
+
+    log.info('staged %s records in %s', rows, directory)
+
+    return rows
+
+def staged_pages(directory:str):
+    """
+    yields the pages staged in directory by stage_pages, in order, as geodataframes. files
+    are memory-mapped rather than read into buffers first.
+
+    dependencies: geopandas as gpd, pyarrow
+    """
+    require_pyarrow()
+
+    for path in sorted(glob.glob(os.path.join(directory, 'part-*.parquet'))):
+        yield gpd.read_parquet(path, memory_map=True)
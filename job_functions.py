@@ -0,0 +1,205 @@
+"""
+Background jobs for the flask api.
+
+long-running work (e.g. full-table refreshes) is submitted to a JobQueue, which runs it on
+a local worker pool and keeps a status record per job that routes can report.
+run_batch runs a set of jobs (e.g. one sync per layer, see etl_all.py) to completion.
+a Batcher coalesces small requests made at about the same time (e.g. single-record
+refreshes) into one batch of work.
+"""
+
+import uuid
+import logging
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from datetime import datetime as dt
+from threading import Event, Lock
+
+
+log = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    runs submitted jobs on a pool of worker threads. each job gets an id and a status
+    record ("queued" -> "running" -> "succeeded"/"failed") with a progress dict that the
+    job updates as it goes. jobs submitted under the key of a job that's still queued or
+    running are de-duplicated into that job.
+
+    only the last max_finished finished jobs are remembered.
+    """
+
+    def __init__(self, workers:int=1, max_finished:int=100):
+        self.max_finished = max_finished
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = OrderedDict()  # job id -> status record, oldest first
+        self._active = {}  # job key -> id of the queued/running job with that key
+        self._lock = Lock()
+
+    def submit(self, key, fn) -> tuple:
+        """
+        queues fn(progress) to run in the background, where progress is a dict the job can
+        fill in (e.g. pages fetched, rows written); whatever fn returns becomes the job's
+        result. returns (status, created): the job's status record, and False if an
+        identical job (same key) was already queued or running and has been reused.
+        """
+        with self._lock:
+            if key in self._active:
+                return self._copy(self._jobs[self._active[key]]), False
+
+            job = {
+                "id": uuid.uuid4().hex,
+                "key": str(key),
+                "status": "queued",
+                "submitted": dt.timestamp(dt.now()),
+                "started": None,
+                "finished": None,
+                "progress": {},
+                "result": None,
+                "error": None,
+            }
+
+            self._jobs[job["id"]] = job
+            self._active[key] = job["id"]
+
+        self._pool.submit(self._run, key, job, fn)
+
+        return self.status(job["id"]), True
+
+    def status(self, job_id:str) -> dict:
+        """
+        returns a copy of a job's status record, or None if the job isn't known
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+            return self._copy(job) if job is not None else None
+
+    @staticmethod
+    def _copy(job:dict) -> dict:
+        return dict(job, progress=dict(job["progress"]))
+
+    def _run(self, key, job:dict, fn) -> None:
+        job["status"] = "running"
+        job["started"] = dt.timestamp(dt.now())
+
+        try:
+            job["result"] = fn(job["progress"])
+            job["status"] = "succeeded"
+
+        except Exception as e:
+            job["error"] = f'{type(e).__name__}: {e}'
+            job["status"] = "failed"
+            log.exception('job %s (%s) failed', job["id"], job["key"])
+
+        finally:
+            job["finished"] = dt.timestamp(dt.now())
+
+            with self._lock:
+                self._active.pop(key, None)
+
+                # forget the oldest finished jobs
+                finished = [i for i, j in self._jobs.items() if j["finished"] is not None]
+
+                for job_id in finished[:max(len(finished) - self.max_finished, 0)]:
+                    del self._jobs[job_id]
+
+
+class Batcher:
+    """
+    coalesces items submitted by concurrent callers into batches. the first caller to submit
+    opens a batch and waits up to window seconds (or until the batch holds max_items) for
+    others to join it, then calls fn once with every item submitted to the batch (duplicates
+    removed, in order). each caller gets fn's result for the whole batch back, or the
+    exception it raised.
+
+    no thread of its own is needed: the caller that opened a batch runs it.
+    """
+
+    def __init__(self, fn, window:float=0.05, max_items:int=None):
+        self.fn = fn
+        self.window = window
+        self.max_items = max_items
+
+        self._batch = None  # the batch that's open for items, if any
+        self._lock = Lock()
+
+    def submit(self, items:list):
+        """
+        adds items to the open batch (opening one if there isn't one) and returns fn's result
+        for the batch once it has run
+        """
+        with self._lock:
+            batch = self._batch
+            opened = batch is None
+
+            if opened:
+                batch = self._batch = {"items": [], "full": Event(), "result": Future()}
+
+            batch["items"].extend(items)
+
+            # a full batch runs right away, and the next caller opens a new one
+            if self.max_items and len(batch["items"]) >= self.max_items:
+                self._batch = None
+                batch["full"].set()
+
+        if opened:
+            batch["full"].wait(self.window)
+
+            with self._lock:
+                if self._batch is batch:
+                    self._batch = None
+
+            items = list(dict.fromkeys(batch["items"]))
+            log.debug('running a batch of %s items', len(items))
+
+            try:
+                batch["result"].set_result(self.fn(items))
+            except Exception as e:
+                batch["result"].set_exception(e)
+
+        return batch["result"].result()
+
+
+def run_batch(jobs:dict, workers:int=4) -> dict:
+    """
+    runs a batch of named jobs ({name: fn}, where fn() returns a dict of results) on a pool
+    of workers threads and waits for all of them; a job that fails doesn't stop the others.
+    returns a run summary: each job's status, duration and result (or error), in the order
+    given, along with the batch's totals.
+    """
+    started = dt.now()
+
+    def run(name, fn):
+        record = {"name": name, "status": "running", "started": dt.timestamp(dt.now()), "result": None, "error": None}
+
+        try:
+            record["result"] = fn()
+            record["status"] = "succeeded"
+
+        except Exception as e:
+            record["error"] = f'{type(e).__name__}: {e}'
+            record["status"] = "failed"
+            log.exception('batch job %s failed', name)
+
+        record["seconds"] = round(dt.timestamp(dt.now()) - record["started"], 3)
+
+        return record
+
+    with ThreadPoolExecutor(max_workers=max(min(workers, len(jobs)), 1), thread_name_prefix='batch') as pool:
+        futures = {pool.submit(run, name, fn): name for name, fn in jobs.items()}
+        records = {futures[f]: f.result() for f in as_completed(futures)}
+
+    finished = dt.now()
+    results = [records[name] for name in jobs]
+
+    return {
+        "started": started.isoformat(timespec='seconds'),
+        "finished": finished.isoformat(timespec='seconds'),
+        "seconds": round((finished - started).total_seconds(), 3),
+        "job_seconds": round(sum(r["seconds"] for r in results), 3),
+        "succeeded": sum(r["status"] == "succeeded" for r in results),
+        "failed": sum(r["status"] == "failed" for r in results),
+        "jobs": results,
+    }
@@ -0,0 +1,188 @@
+"""
+in-process metrics for the etl functions and the flask api, exposed in the prometheus text
+format (see render, served by the api at '/metrics').
+
+the etl functions time each stage of their work with stage(): 'fetch' (http requests to
+arcgis), 'decode' (parsing response bodies), 'build' (making geodataframes), 'db_write',
+'db_read' and 'analyze' (calc_functions), recording durations along with row and byte counts. http requests and
+retries are counted per host, and the api records its request latencies.
+
+metrics are kept per process; when the api runs as several worker processes, each one
+reports its own.
+"""
+
+import time
+import logging
+from contextlib import contextmanager
+from threading import Lock
+
+
+log = logging.getLogger(__name__)
+
+# upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+# metric name -> (type, help text)
+METRICS = {
+    "etl_stage_seconds": ("histogram", "time spent in each etl stage"),
+    "etl_stage_rows_total": ("counter", "rows handled by each etl stage"),
+    "etl_stage_bytes_total": ("counter", "bytes handled by each etl stage"),
+    "etl_stage_errors_total": ("counter", "etl stage runs that raised an exception"),
+    "etl_http_requests_total": ("counter", "requests made to arcgis hosts, by response status"),
+    "etl_http_retries_total": ("counter", "requests to arcgis hosts that were retried"),
+    "etl_http_wait_seconds_total": ("counter", "time requests spent waiting for their host's limits"),
+    "etl_response_cache_total": ("counter", "arcgis queries looked up in the response cache, by result"),
+    "api_request_seconds": ("histogram", "api request latency, by route, method and status"),
+}
+
+
+class Registry:
+    """
+    thread-safe store of counters and histograms, keyed by metric name and label values
+    """
+
+    def __init__(self, buckets:tuple=BUCKETS):
+        self.buckets = buckets
+
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._lock = Lock()
+
+    def inc(self, name:str, value:float=1, **labels) -> None:
+        """
+        adds value to a counter
+        """
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name:str, value:float, **labels) -> None:
+        """
+        records one observation (e.g. a duration in seconds) in a histogram
+        """
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+        with self._lock:
+            hist = self._histograms.get(key)
+
+            if hist is None:
+                hist = self._histograms[key] = [0] * (len(self.buckets) + 2)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+
+            hist[-2] += value
+            hist[-1] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        """
+        returns every metric in the prometheus text exposition format
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+
+        lines = []
+
+        for name, (kind, doc) in METRICS.items():
+            samples = []
+
+            if kind == 'counter':
+                for (n, labels), value in sorted(counters.items()):
+                    if n == name:
+                        samples.append(f'{name}{fmt_labels(labels)} {value}')
+
+            else:
+                for (n, labels), hist in sorted(histograms.items()):
+                    if n != name:
+                        continue
+
+                    for bound, count in zip(self.buckets, hist):
+                        samples.append(f'{name}_bucket{fmt_labels(labels + (("le", str(bound)),))} {count}')
+
+                    samples.append(f'{name}_bucket{fmt_labels(labels + (("le", "+Inf"),))} {hist[-1]}')
+                    samples.append(f'{name}_sum{fmt_labels(labels)} {round(hist[-2], 6)}')
+                    samples.append(f'{name}_count{fmt_labels(labels)} {hist[-1]}')
+
+            if samples:
+                lines += [f'# HELP {name} {doc}', f'# TYPE {name} {kind}'] + samples
+
+        return '\n'.join(lines) + '\n'
+
+
+def fmt_labels(labels:tuple) -> str:
+    """
+    formats (name, value) label pairs as a prometheus label set, e.g. {stage="fetch"}
+    """
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+# the process-wide registry used by the helpers below
+registry = Registry()
+
+def inc(name:str, value:float=1, **labels) -> None:
+    registry.inc(name, value, **labels)
+
+def observe(name:str, value:float, **labels) -> None:
+    registry.observe(name, value, **labels)
+
+def render() -> str:
+    return registry.render()
+
+@contextmanager
+def stage(name:str, **labels):
+    """
+    times the enclosed block as one run of etl stage name. yields a dict in which the
+    block can set the "rows" and "bytes" it handled, which are added to the stage's counters.
+    the duration is logged at debug level.
+
+        with stage('fetch', host=host) as counts:
+            d = session.get(url)
+            counts["bytes"] = len(d.content)
+    """
+    counts = {}
+    start = time.perf_counter()
+
+    try:
+        yield counts
+
+    except Exception:
+        inc("etl_stage_errors_total", stage=name, **labels)
+        raise
+
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("etl_stage_seconds", elapsed, stage=name, **labels)
+
+        if counts.get("rows"):
+            inc("etl_stage_rows_total", counts["rows"], stage=name, **labels)
+
+        if counts.get("bytes"):
+            inc("etl_stage_bytes_total", counts["bytes"], stage=name, **labels)
+
+        log.debug('%s took %.3fs %s', name, elapsed, counts)
+
+def count_request(host:str, response) -> None:
+    """
+    counts a requests response from an arcgis host, and any retries urllib3 made for it
+    (per the session adapter's retry policy)
+    """
+    inc("etl_http_requests_total", host=host, status=response.status_code)
+
+    retries = getattr(response.raw, 'retries', None)
+
+    if retries is not None and retries.history:
+        inc("etl_http_retries_total", len(retries.history), host=host)